@@ -1,13 +1,18 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 from datetime import datetime, timezone
+from functools import partial
 import sys
-from time import sleep
+from typing import Dict, List, Set
 
 from dateutil import parser
 from loguru import logger
 import openstack
 from oslo_config import cfg
+from tabulate import tabulate
+
+import inventory
+from waiter import AmphoraWaiter, FailoverScheduler
 
 PROJECT_NAME = "amphora"
 CONF = cfg.CONF
@@ -18,16 +23,39 @@ opts = [
     cfg.BoolOpt("rotate", help="Rotate all amphorae older than 30 days", default=False),
     cfg.StrOpt("cloud", help="Cloud name in clouds.yaml", default="service"),
     cfg.StrOpt("loadbalancer", help="Loadbalancer ID", default=None),
+    cfg.IntOpt(
+        "parallel-failovers",
+        help="Number of amphora or loadbalancer failovers running at once",
+        default=1,
+        min=1,
+    ),
+    cfg.IntOpt(
+        "max-per-az",
+        help="Number of failovers running at once per availability zone, 0 is unlimited",
+        default=0,
+        min=0,
+    ),
+    cfg.IntOpt(
+        "max-per-host",
+        help="Number of failovers running at once per compute host, 0 is unlimited",
+        default=0,
+        min=0,
+    ),
+    cfg.IntOpt(
+        "max-per-project",
+        help="Number of failovers running at once per project, 0 is unlimited",
+        default=0,
+        min=0,
+    ),
 ]
 CONF.register_cli_opts(opts)
 CONF(sys.argv[1:], project=PROJECT_NAME)
 
-SLEEP_WAIT_FOR_AMPHORA_BOOT = 5
 TIMEOUT_WAIT_FOR_AMPHORA_BOOT = 120
-
-SLEEP_WAIT_FOR_AMPHORA_DELETE = 5
 TIMEOUT_WAIT_FOR_AMPHORA_DELETE = 60
 
+RETRY_FAILOVER_AMPHORA = 3
+
 if CONF.debug:
     level = "DEBUG"
 else:
@@ -42,112 +70,202 @@ logger.remove()
 logger.add(sys.stderr, format=log_fmt, level=level, colorize=True)
 
 
-def wait_for_amphora_boot(loadbalancer_id):
-    global cloud
+def watch_failover(loadbalancer_id, callback=None):
+    # wait for the boot of the new amphorae and then for the delete of the old ones
+    def booted(loadbalancer_id, completed):
+        if not completed:
+            if callback:
+                callback(loadbalancer_id, False)
+            return
 
-    logger.info(
-        f"Wait up to {TIMEOUT_WAIT_FOR_AMPHORA_BOOT} seconds for amphora boot of loadbalancer {loadbalancer_id}"
-    )
+        waiter.watch(
+            loadbalancer_id,
+            "PENDING_DELETE",
+            TIMEOUT_WAIT_FOR_AMPHORA_DELETE,
+            callback,
+        )
 
-    i = TIMEOUT_WAIT_FOR_AMPHORA_BOOT / SLEEP_WAIT_FOR_AMPHORA_BOOT
+    waiter.watch(loadbalancer_id, "BOOTING", TIMEOUT_WAIT_FOR_AMPHORA_BOOT, booted)
 
-    while i:
-        amphorae = cloud.load_balancer.amphorae(
-            loadbalancer_id=loadbalancer_id, status="BOOTING"
-        )
-        if not [1 for x in amphorae]:
-            break
-        i = i - 1
-        sleep(SLEEP_WAIT_FOR_AMPHORA_BOOT)
 
+def report(results):
+    """Print the outcome of all failovers, return False if one failed"""
 
-def wait_for_amphora_delete(loadbalancer_id):
-    global cloud
+    if not results:
+        return True
 
-    logger.info(
-        f"Wait up to {TIMEOUT_WAIT_FOR_AMPHORA_DELETE} seconds for amphora delete of loadbalancer {loadbalancer_id}"
+    print(
+        tabulate(
+            sorted(results.items()),
+            headers=["Failover", "Status"],
+            tablefmt="psql",
+        )
     )
+    return all(result == "DONE" for result in results.values())
 
-    i = TIMEOUT_WAIT_FOR_AMPHORA_DELETE / SLEEP_WAIT_FOR_AMPHORA_DELETE
 
-    while i:
-        amphorae = cloud.load_balancer.amphorae(
-            loadbalancer_id=loadbalancer_id, status="PENDING_DELETE"
-        )
-        if not [1 for x in amphorae]:
-            break
-        i = i - 1
-        sleep(SLEEP_WAIT_FOR_AMPHORA_DELETE)
+def get_labels(amphora):
+    labels = {"availability_zone": {amphora.cached_zone}}
+
+    # the compute host and the project require an additional API call
+    if CONF.max_per_host:
+        compute_host = "unknown"
+        # amphorae in ERROR often have no or an already deleted server
+        if amphora.compute_id:
+            try:
+                server = cloud.compute.get_server(amphora.compute_id)
+                compute_host = server.compute_host or compute_host
+            except openstack.exceptions.NotFoundException:
+                logger.warning(
+                    f"Server {amphora.compute_id} of amphora {amphora.id} not found"
+                )
+        labels["compute_host"] = {compute_host}
+    if CONF.max_per_project:
+        project_id = "unknown"
+        # amphorae in ERROR may have no or an already deleted load balancer
+        if amphora.loadbalancer_id:
+            try:
+                load_balancer = cloud.load_balancer.get_load_balancer(
+                    amphora.loadbalancer_id
+                )
+                project_id = load_balancer.project_id or project_id
+            except openstack.exceptions.NotFoundException:
+                logger.warning(
+                    f"Loadbalancer {amphora.loadbalancer_id} of amphora {amphora.id} not found"
+                )
+        labels["project"] = {project_id}
+
+    return labels
 
 
 def restore(loadbalancer_id: str):
+    # The amphorae are failed over right away, they are never listed from
+    # the cache.
     if loadbalancer_id:
-        result = cloud.load_balancer.amphorae(
-            status="ERROR", loadbalancer_id=loadbalancer_id
+        result = inventory.listing(
+            "load_balancer.amphorae",
+            cloud.load_balancer.amphorae,
+            cache=False,
+            status="ERROR",
+            loadbalancer_id=loadbalancer_id,
         )
     else:
-        result = cloud.load_balancer.amphorae(status="ERROR")
+        result = inventory.listing(
+            "load_balancer.amphorae",
+            cloud.load_balancer.amphorae,
+            cache=False,
+            status="ERROR",
+        )
+
+    scheduler = FailoverScheduler(
+        waiter,
+        watch_failover,
+        CONF.parallel_failovers,
+        {
+            "availability_zone": CONF.max_per_az,
+            "compute_host": CONF.max_per_host,
+            "project": CONF.max_per_project,
+        },
+        RETRY_FAILOVER_AMPHORA,
+    )
 
+    # The amphorae of one loadbalancer are failed over one after the other,
+    # the scheduler admits only one failover per loadbalancer at once.
+    # Amphorae without a loadbalancer are failed over independently.
     for amphora in result:
         logger.info(
             f"Amphora {amphora.id} of loadbalancer {amphora.loadbalancer_id} is in state ERROR, trigger amphora failover"
         )
-        cloud.load_balancer.failover_amphora(amphora.id)
-        sleep(10)  # wait for the octavia API
+        scheduler.add(
+            amphora.loadbalancer_id or amphora.id,
+            partial(cloud.load_balancer.failover_amphora, amphora.id),
+            get_labels(amphora),
+            f"amphora {amphora.id}",
+        )
 
-        wait_for_amphora_boot(amphora.loadbalancer_id)
-        wait_for_amphora_delete(amphora.loadbalancer_id)
+    return report(scheduler.run())
 
 
 def rotate(loadbalancer_id: str):
-    done = []
+    scheduler = FailoverScheduler(
+        waiter,
+        watch_failover,
+        CONF.parallel_failovers,
+        {
+            "availability_zone": CONF.max_per_az,
+            "compute_host": CONF.max_per_host,
+            "project": CONF.max_per_project,
+        },
+    )
 
     if loadbalancer_id:
-        result = cloud.load_balancer.amphorae(
-            status="ALLOCATED", loadbalancer_id=loadbalancer_id
+        result = inventory.listing(
+            "load_balancer.amphorae",
+            cloud.load_balancer.amphorae,
+            cache=False,
+            status="ALLOCATED",
+            loadbalancer_id=loadbalancer_id,
         )
     else:
-        result = cloud.load_balancer.amphorae(status="ALLOCATED")
+        result = inventory.listing(
+            "load_balancer.amphorae",
+            cloud.load_balancer.amphorae,
+            cache=False,
+            status="ALLOCATED",
+        )
 
+    # A failover replaces all amphorae of a loadbalancer, e.g. both amphorae of
+    # an ACTIVE_STANDBY loadbalancer. Each loadbalancer is failed over once.
+    loadbalancers: Dict[str, List] = {}
     for amphora in result:
+        loadbalancers.setdefault(amphora.loadbalancer_id, []).append(amphora)
+
+    for loadbalancer_id, amphorae in loadbalancers.items():
         rotate = False
 
-        if amphora.loadbalancer_id in done:
-            next
-
-        duration = datetime.now(timezone.utc) - parser.parse(amphora.created_at)
-        if duration.total_seconds() > 2592000:  # 30 days
-            logger.info(f"Amphora {amphora.id} is older than 30 days")
-            rotate = True
-        elif CONF.force:
-            logger.info(f"Force rotation of Amphora {amphora.id}")
-            rotate = True
-        else:
-            next
-
-        if rotate:
-            logger.info(
-                f"Amphora {amphora.id} of loadbalancer {amphora.loadbalancer_id} is rotated by a loadbalancer failover"
-            )
-            try:
-                cloud.load_balancer.failover_load_balancer(amphora.loadbalancer_id)
-                sleep(10)  # wait for the octavia API
+        for amphora in amphorae:
+            duration = datetime.now(timezone.utc) - parser.parse(amphora.created_at)
+            if duration.total_seconds() > 2592000:  # 30 days
+                logger.info(f"Amphora {amphora.id} is older than 30 days")
+                rotate = True
+            elif CONF.force:
+                logger.info(f"Force rotation of Amphora {amphora.id}")
+                rotate = True
+
+        if not rotate:
+            continue
 
-                done.append(amphora.loadbalancer_id)
+        logger.info(
+            f"Amphorae {', '.join(amphora.id for amphora in amphorae)} of loadbalancer {loadbalancer_id} are rotated by a loadbalancer failover"
+        )
 
-                wait_for_amphora_boot(amphora.loadbalancer_id)
-                wait_for_amphora_delete(amphora.loadbalancer_id)
-            except openstack.exceptions.ConflictException:
-                pass
+        labels: Dict[str, Set] = {}
+        for amphora in amphorae:
+            for key, values in get_labels(amphora).items():
+                labels.setdefault(key, set()).update(values)
+
+        scheduler.add(
+            loadbalancer_id,
+            partial(cloud.load_balancer.failover_load_balancer, loadbalancer_id),
+            labels,
+        )
+
+    return report(scheduler.run())
 
 
 # Connect to the OpenStack environment
 cloud = openstack.connect(cloud=CONF.cloud)
+waiter = AmphoraWaiter(cloud)
+
+success = True
 
 # Restore all amphorae in state ERROR
 if CONF.restore:
-    restore(CONF.loadbalancer)
+    success = restore(CONF.loadbalancer) and success
 
 # Rotate all amphorae
 if CONF.rotate:
-    rotate(CONF.loadbalancer)
+    success = rotate(CONF.loadbalancer) and success
+
+if not success:
+    sys.exit(1)
@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Plan/apply mode for remediation actions, shared by the tools. With --plan
+# all actions are collected first, shown as one plan, confirmed once and
+# then run in parallel with their outcome tracked per action.
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+from loguru import logger
+import openstack
+from oslo_config import cfg
+from prompt_toolkit import prompt
+from tabulate import tabulate
+from typing import Callable, List, Optional, Tuple
+
+from connection import get_cloud
+
+CONF = cfg.CONF
+opts = [
+    cfg.BoolOpt(
+        "plan",
+        help="Collect all actions into one plan, confirm it once and apply it in parallel",
+        default=False,
+    ),
+    cfg.StrOpt(
+        "plan-file", help="Write the plan as JSON Lines to this file", default=None
+    ),
+    cfg.IntOpt(
+        "parallel",
+        help="Number of planned actions applied in parallel",
+        default=8,
+        min=1,
+    ),
+]
+CONF.register_cli_opts(opts)
+
+
+def unchanged(resource, get):
+    """Return a check that the resource is still in the status it was listed
+    with, the listing may come from the cache or the plan may be applied
+    later. get(cloud, resource_id) returns the current resource."""
+
+    return lambda cloud: get(cloud, resource.id).status == resource.status
+
+
+def applicable(cloud, resource_id, description, check):
+    """Return False if check fails or the resource is gone"""
+
+    if not check:
+        return True
+
+    try:
+        if check(cloud):
+            return True
+    except openstack.exceptions.NotFoundException:
+        pass
+
+    logger.info(f"{description} {resource_id} skipped, it changed since it was listed")
+    return False
+
+
+def execute(resource_id, description, action, check):
+    # The planned actions are applied in worker threads, each worker thread
+    # holds its own connection to the cloud.
+    cloud = get_cloud()
+    if not applicable(cloud, resource_id, description, check):
+        return "SKIPPED"
+
+    action(cloud)
+    logger.info(f"{description} {resource_id} done")
+    return "DONE"
+
+
+class Plan:
+    """Actions of one run, collected with --plan and applied at the end"""
+
+    def __init__(self) -> None:
+        self.actions: List[Tuple[str, str, Callable, Optional[Callable]]] = []
+
+    def run(self, cloud, resource_id, description, action, question=None, check=None):
+        """Run an action right away or add it to the plan with --plan
+
+        check is called with the cloud right before the action, the action is
+        skipped if it returns False or the resource is gone."""
+
+        if CONF.plan:
+            logger.debug(f"Planning {description} of {resource_id}")
+            self.actions.append((resource_id, description, action, check))
+            return
+
+        if not applicable(cloud, resource_id, description, check):
+            return
+
+        if question and prompt(f"{question} [yes/no]: ") != "yes":
+            return
+
+        logger.info(f"{description} {resource_id}")
+        action(cloud)
+
+    def apply(self):
+        """Show the plan, confirm it once and apply all actions in parallel"""
+
+        if not CONF.plan:
+            return
+
+        if not self.actions:
+            logger.info("Nothing to do")
+            return
+
+        print(
+            tabulate(
+                [
+                    [resource_id, description]
+                    for resource_id, description, _, _ in self.actions
+                ],
+                headers=["Resource", "Action"],
+                tablefmt="psql",
+            )
+        )
+
+        if CONF.plan_file:
+            with open(CONF.plan_file, "w") as fp:
+                for resource_id, description, _, _ in self.actions:
+                    fp.write(
+                        json.dumps({"resource": resource_id, "action": description})
+                    )
+                    fp.write("\n")
+            logger.info(f"Plan written to {CONF.plan_file}")
+
+        if prompt(f"Apply {len(self.actions)} actions [yes/no]: ") != "yes":
+            return
+
+        result = []
+        with ThreadPoolExecutor(max_workers=CONF.parallel) as executor:
+            futures = [
+                (
+                    resource_id,
+                    description,
+                    executor.submit(execute, resource_id, description, action, check),
+                )
+                for resource_id, description, action, check in self.actions
+            ]
+
+            for resource_id, description, future in futures:
+                try:
+                    status = future.result()
+                except Exception as e:
+                    logger.error(f"{description} {resource_id} failed: {e}")
+                    status = f"FAILED ({e})"
+                result.append([resource_id, description, status])
+
+        print(
+            tabulate(
+                result,
+                headers=["Resource", "Action", "Status"],
+                tablefmt="psql",
+            )
+        )
+        done = len([1 for _, _, status in result if status == "DONE"])
+        skipped = len([1 for _, _, status in result if status == "SKIPPED"])
+        failed = len(result) - done - skipped
+        logger.info(
+            f"{done} actions done, {skipped} actions skipped, {failed} actions failed"
+        )
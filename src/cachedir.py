@@ -0,0 +1,11 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Directory of the on-disk caches of the tools. Kept free of dependencies, it
+# is shared by the OpenStack tools and the database tools.
+
+import os
+
+CACHE_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "openstack-resource-manager",
+)
@@ -25,17 +25,38 @@ import datetime
 import logging
 import os
 import sys
+import time
 
 from openstack import connection, exceptions
 
-from sqlalchemy import and_, MetaData, select, Table, create_engine
+from sqlalchemy import and_, func, MetaData, select, create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+import schema
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 
+# rows are soft deleted in chunks of this size, each chunk in its own
+# transaction, with this many seconds of pause between two chunks
+SOFT_DELETE_CHUNK_SIZE = 1000
+SOFT_DELETE_THROTTLE = 0.0
+
+# all tables used by the checks, reflected once at startup
+TABLE_NAMES = [
+    "groups",
+    "group_volume_type_mapping",
+    "services",
+    "snapshot_metadata",
+    "snapshots",
+    "volume_admin_metadata",
+    "volume_attachment",
+    "volume_glance_metadata",
+    "volume_metadata",
+    "volumes",
+]
+
 
 # get all instances from nova
 def get_nova_instances(conn):
@@ -73,10 +94,44 @@ def get_nova_instances(conn):
     return nova_instances
 
 
+# soft delete all rows of a table with a value of column in ids, chunk by chunk
+def soft_delete(
+    meta,
+    table_t,
+    ids,
+    column="id",
+    chunk_size=SOFT_DELETE_CHUNK_SIZE,
+    throttle=SOFT_DELETE_THROTTLE,
+):
+    ids = list(ids)
+    for i in range(0, len(ids), chunk_size):
+        end = i + chunk_size
+        chunk = ids[i:end]
+        log.info(
+            "-- action: deleting %s rows %d to %d of %d (by %s)",
+            table_t.name,
+            i + 1,
+            i + len(chunk),
+            len(ids),
+            column,
+        )
+        now = datetime.datetime.utcnow()
+        soft_delete_q = (
+            table_t.update()
+            .where(and_(table_t.c[column].in_(chunk), table_t.c.deleted == 0))
+            .values(updated_at=now, deleted_at=now, deleted=1)
+        )
+        with meta.bind.begin() as connection:
+            connection.execute(soft_delete_q)
+
+        if throttle and i + len(chunk) < len(ids):
+            time.sleep(throttle)
+
+
 # get all volume attachments for volumes
 def get_orphan_volume_attachments(meta):
     orphan_volume_attachments = {}
-    orphan_volume_attachment_t = Table("volume_attachment", meta, autoload=True)
+    orphan_volume_attachment_t = schema.table(meta, "volume_attachment")
     columns = [
         orphan_volume_attachment_t.c.id,
         orphan_volume_attachment_t.c.instance_uuid,
@@ -113,23 +168,17 @@ def get_wrong_orphan_volume_attachments(nova_instances, orphan_volume_attachment
 
 # delete volume attachments in the cinder db for already deleted instances in nova
 def fix_wrong_orphan_volume_attachments(
-    meta, wrong_orphan_volume_attachments, fix_limit
+    meta, wrong_orphan_volume_attachments, fix_limit, chunk_size, throttle
 ):
     if len(wrong_orphan_volume_attachments) <= int(fix_limit):
-        orphan_volume_attachment_t = Table("volume_attachment", meta, autoload=True)
-
-        for orphan_volume_attachment_id in wrong_orphan_volume_attachments:
-            log.info(
-                "-- action: deleting orphan volume attachment id: %s",
-                orphan_volume_attachment_id,
-            )
-            now = datetime.datetime.utcnow()
-            delete_orphan_volume_attachment_q = (
-                orphan_volume_attachment_t.update()
-                .where(orphan_volume_attachment_t.c.id == orphan_volume_attachment_id)
-                .values(updated_at=now, deleted_at=now, deleted=1)
-            )
-            delete_orphan_volume_attachment_q.execute()
+        orphan_volume_attachment_t = schema.table(meta, "volume_attachment")
+        soft_delete(
+            meta,
+            orphan_volume_attachment_t,
+            wrong_orphan_volume_attachments,
+            chunk_size=chunk_size,
+            throttle=throttle,
+        )
 
     else:
         log.warn(
@@ -142,7 +191,7 @@ def fix_wrong_orphan_volume_attachments(
 def get_error_deleting_volumes(meta):
     error_deleting_volumes = []
 
-    volumes_t = Table("volumes", meta, autoload=True)
+    volumes_t = schema.table(meta, "volumes")
     error_deleting_volumes_q = select(columns=[volumes_t.c.id]).where(
         and_(volumes_t.c.status == "error_deleting", volumes_t.c.deleted == 0)
     )
@@ -155,58 +204,51 @@ def get_error_deleting_volumes(meta):
 
 
 # delete all the volumes in state "error_deleting"
-def fix_error_deleting_volumes(meta, error_deleting_volumes):
-    volumes_t = Table("volumes", meta, autoload=True)
-    volume_attachment_t = Table("volume_attachment", meta, autoload=True)
-    volume_metadata_t = Table("volume_metadata", meta, autoload=True)
-    volume_admin_metadata_t = Table("volume_admin_metadata", meta, autoload=True)
-
-    for error_deleting_volumes_id in error_deleting_volumes:
-        now = datetime.datetime.utcnow()
-        log.info(
-            "-- action: deleting possible volume admin metadata for volume id: %s",
-            error_deleting_volumes_id,
-        )
-        delete_volume_admin_metadata_q = (
-            volume_admin_metadata_t.update()
-            .where(volume_admin_metadata_t.c.volume_id == error_deleting_volumes_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_admin_metadata_q.execute()
-        log.info(
-            "-- action: deleting possible volume metadata for volume id: %s",
-            error_deleting_volumes_id,
-        )
-        delete_volume_metadata_q = (
-            volume_metadata_t.update()
-            .where(volume_metadata_t.c.volume_id == error_deleting_volumes_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_metadata_q.execute()
-        log.info(
-            "-- action: deleting possible volume attachments for volume id: %s",
-            error_deleting_volumes_id,
-        )
-        delete_volume_attachment_q = (
-            volume_attachment_t.update()
-            .where(volume_attachment_t.c.volume_id == error_deleting_volumes_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_attachment_q.execute()
-        log.info("-- action: deleting volume id: %s", error_deleting_volumes_id)
-        delete_volume_q = (
-            volumes_t.update()
-            .where(volumes_t.c.id == error_deleting_volumes_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_q.execute()
+def fix_error_deleting_volumes(meta, error_deleting_volumes, chunk_size, throttle):
+    volumes_t = schema.table(meta, "volumes")
+    volume_attachment_t = schema.table(meta, "volume_attachment")
+    volume_metadata_t = schema.table(meta, "volume_metadata")
+    volume_admin_metadata_t = schema.table(meta, "volume_admin_metadata")
+
+    # the volumes are deleted last, after everything referencing them
+    soft_delete(
+        meta,
+        volume_admin_metadata_t,
+        error_deleting_volumes,
+        "volume_id",
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
+    soft_delete(
+        meta,
+        volume_metadata_t,
+        error_deleting_volumes,
+        "volume_id",
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
+    soft_delete(
+        meta,
+        volume_attachment_t,
+        error_deleting_volumes,
+        "volume_id",
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
+    soft_delete(
+        meta,
+        volumes_t,
+        error_deleting_volumes,
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
 
 
 # get all the snapshots in state "error_deleting"
 def get_error_deleting_snapshots(meta):
     error_deleting_snapshots = []
 
-    snapshots_t = Table("snapshots", meta, autoload=True)
+    snapshots_t = schema.table(meta, "snapshots")
     error_deleting_snapshots_q = select(columns=[snapshots_t.c.id]).where(
         and_(snapshots_t.c.status == "error_deleting", snapshots_t.c.deleted == 0)
     )
@@ -219,25 +261,22 @@ def get_error_deleting_snapshots(meta):
 
 
 # delete all the snapshots in state "error_deleting"
-def fix_error_deleting_snapshots(meta, error_deleting_snapshots):
-    snapshots_t = Table("snapshots", meta, autoload=True)
-
-    for error_deleting_snapshots_id in error_deleting_snapshots:
-        log.info("-- action: deleting snapshot id: %s", error_deleting_snapshots_id)
-        now = datetime.datetime.utcnow()
-        delete_snapshot_q = (
-            snapshots_t.update()
-            .where(snapshots_t.c.id == error_deleting_snapshots_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_snapshot_q.execute()
+def fix_error_deleting_snapshots(meta, error_deleting_snapshots, chunk_size, throttle):
+    snapshots_t = schema.table(meta, "snapshots")
+    soft_delete(
+        meta,
+        snapshots_t,
+        error_deleting_snapshots,
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
 
 
 # get all the rows with a volume_admin_metadata still defined where the corresponding volume is already deleted
 def get_wrong_volume_admin_metadata(meta):
     wrong_admin_metadata = {}
-    volume_admin_metadata_t = Table("volume_admin_metadata", meta, autoload=True)
-    volumes_t = Table("volumes", meta, autoload=True)
+    volume_admin_metadata_t = schema.table(meta, "volume_admin_metadata")
+    volumes_t = schema.table(meta, "volumes")
     admin_metadata_join = volume_admin_metadata_t.join(
         volumes_t, volume_admin_metadata_t.c.volume_id == volumes_t.c.id
     )
@@ -265,27 +304,22 @@ def get_wrong_volume_admin_metadata(meta):
 
 
 # delete volume_admin_metadata still defined where the corresponding volume is already deleted
-def fix_wrong_volume_admin_metadata(meta, wrong_admin_metadata):
-    volume_admin_metadata_t = Table("volume_admin_metadata", meta, autoload=True)
-
-    for volume_admin_metadata_id in wrong_admin_metadata:
-        log.info(
-            "-- action: deleting volume_admin_metadata id: %s", volume_admin_metadata_id
-        )
-        now = datetime.datetime.utcnow()
-        delete_volume_admin_metadata_q = (
-            volume_admin_metadata_t.update()
-            .where(volume_admin_metadata_t.c.id == volume_admin_metadata_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_admin_metadata_q.execute()
+def fix_wrong_volume_admin_metadata(meta, wrong_admin_metadata, chunk_size, throttle):
+    volume_admin_metadata_t = schema.table(meta, "volume_admin_metadata")
+    soft_delete(
+        meta,
+        volume_admin_metadata_t,
+        wrong_admin_metadata,
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
 
 
 # get all the rows with a volume_glance_metadata still defined where the corresponding volume is already deleted
 def get_wrong_volume_glance_metadata_volumes(meta):
     wrong_glance_metadata = {}
-    volume_glance_metadata_t = Table("volume_glance_metadata", meta, autoload=True)
-    volumes_t = Table("volumes", meta, autoload=True)
+    volume_glance_metadata_t = schema.table(meta, "volume_glance_metadata")
+    volumes_t = schema.table(meta, "volumes")
     glance_metadata_join = volume_glance_metadata_t.join(
         volumes_t, volume_glance_metadata_t.c.volume_id == volumes_t.c.id
     )
@@ -313,28 +347,24 @@ def get_wrong_volume_glance_metadata_volumes(meta):
 
 
 # delete volume_glance_metadata still defined where the corresponding volume is already deleted
-def fix_wrong_volume_glance_metadata_volumes(meta, wrong_glance_metadata):
-    volume_glance_metadata_t = Table("volume_glance_metadata", meta, autoload=True)
-
-    for volume_glance_metadata_id in wrong_glance_metadata:
-        log.info(
-            "-- action: deleting volume_glance_metadata id (volume): %s",
-            volume_glance_metadata_id,
-        )
-        now = datetime.datetime.utcnow()
-        delete_volume_glance_metadata_q = (
-            volume_glance_metadata_t.update()
-            .where(volume_glance_metadata_t.c.id == volume_glance_metadata_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_glance_metadata_q.execute()
+def fix_wrong_volume_glance_metadata_volumes(
+    meta, wrong_glance_metadata, chunk_size, throttle
+):
+    volume_glance_metadata_t = schema.table(meta, "volume_glance_metadata")
+    soft_delete(
+        meta,
+        volume_glance_metadata_t,
+        wrong_glance_metadata,
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
 
 
 # get all the rows with a volume_glance_metadata still defined where the corresponding snapshot is already deleted
 def get_wrong_volume_glance_metadata_snapshots(meta):
     wrong_glance_metadata = {}
-    volume_glance_metadata_t = Table("volume_glance_metadata", meta, autoload=True)
-    snapshots_t = Table("snapshots", meta, autoload=True)
+    volume_glance_metadata_t = schema.table(meta, "volume_glance_metadata")
+    snapshots_t = schema.table(meta, "snapshots")
     glance_metadata_join = volume_glance_metadata_t.join(
         snapshots_t, volume_glance_metadata_t.c.snapshot_id == snapshots_t.c.id
     )
@@ -364,28 +394,24 @@ def get_wrong_volume_glance_metadata_snapshots(meta):
 
 
 # delete volume_glance_metadata still defined where the corresponding volume is snapshot deleted
-def fix_wrong_volume_glance_metadata_snapshots(meta, wrong_glance_metadata):
-    volume_glance_metadata_t = Table("volume_glance_metadata", meta, autoload=True)
-
-    for volume_glance_metadata_id in wrong_glance_metadata:
-        log.info(
-            "-- action: deleting volume_glance_metadata id (snapshot): %s",
-            volume_glance_metadata_id,
-        )
-        now = datetime.datetime.utcnow()
-        delete_volume_glance_metadata_q = (
-            volume_glance_metadata_t.update()
-            .where(volume_glance_metadata_t.c.id == volume_glance_metadata_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_glance_metadata_q.execute()
+def fix_wrong_volume_glance_metadata_snapshots(
+    meta, wrong_glance_metadata, chunk_size, throttle
+):
+    volume_glance_metadata_t = schema.table(meta, "volume_glance_metadata")
+    soft_delete(
+        meta,
+        volume_glance_metadata_t,
+        wrong_glance_metadata,
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
 
 
 # get all the rows with a volume_metadata still defined where the corresponding volume is already deleted
 def get_wrong_volume_metadata(meta):
     wrong_metadata = {}
-    volume_metadata_t = Table("volume_metadata", meta, autoload=True)
-    volumes_t = Table("volumes", meta, autoload=True)
+    volume_metadata_t = schema.table(meta, "volume_metadata")
+    volumes_t = schema.table(meta, "volumes")
     metadata_join = volume_metadata_t.join(
         volumes_t, volume_metadata_t.c.volume_id == volumes_t.c.id
     )
@@ -413,25 +439,22 @@ def get_wrong_volume_metadata(meta):
 
 
 # delete volume_metadata still defined where the corresponding volume is already deleted
-def fix_wrong_volume_metadata(meta, wrong_metadata):
-    volume_metadata_t = Table("volume_metadata", meta, autoload=True)
-
-    for volume_metadata_id in wrong_metadata:
-        log.info("-- action: deleting volume_metadata id: %s", volume_metadata_id)
-        now = datetime.datetime.utcnow()
-        delete_volume_metadata_q = (
-            volume_metadata_t.update()
-            .where(volume_metadata_t.c.id == volume_metadata_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_volume_metadata_q.execute()
+def fix_wrong_volume_metadata(meta, wrong_metadata, chunk_size, throttle):
+    volume_metadata_t = schema.table(meta, "volume_metadata")
+    soft_delete(
+        meta,
+        volume_metadata_t,
+        wrong_metadata,
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
 
 
 # get all the rows with a volume attachment still defined where the corresponding volume is already deleted
 def get_wrong_volume_attachments(meta):
     wrong_attachments = {}
-    volume_attachment_t = Table("volume_attachment", meta, autoload=True)
-    volumes_t = Table("volumes", meta, autoload=True)
+    volume_attachment_t = schema.table(meta, "volume_attachment")
+    volumes_t = schema.table(meta, "volumes")
     attachment_join = volume_attachment_t.join(
         volumes_t, volume_attachment_t.c.volume_id == volumes_t.c.id
     )
@@ -459,21 +482,18 @@ def get_wrong_volume_attachments(meta):
 
 
 # delete volume attachment still defined where the corresponding volume is already deleted
-def fix_wrong_volume_attachments(meta, wrong_attachments, fix_limit):
+def fix_wrong_volume_attachments(
+    meta, wrong_attachments, fix_limit, chunk_size, throttle
+):
     if len(wrong_attachments) <= int(fix_limit):
-        volume_attachment_t = Table("volume_attachment", meta, autoload=True)
-
-        for volume_attachment_id in wrong_attachments:
-            log.info(
-                "-- action: deleting volume attachment id: %s", volume_attachment_id
-            )
-            now = datetime.datetime.utcnow()
-            delete_volume_attachment_q = (
-                volume_attachment_t.update()
-                .where(volume_attachment_t.c.id == volume_attachment_id)
-                .values(updated_at=now, deleted_at=now, deleted=1)
-            )
-            delete_volume_attachment_q.execute()
+        volume_attachment_t = schema.table(meta, "volume_attachment")
+        soft_delete(
+            meta,
+            volume_attachment_t,
+            wrong_attachments,
+            chunk_size=chunk_size,
+            throttle=throttle,
+        )
 
     else:
         log.warn(
@@ -485,8 +505,8 @@ def fix_wrong_volume_attachments(meta, wrong_attachments, fix_limit):
 # get all the rows with a snapshot_metadata still defined where the corresponding snapshot is already deleted
 def get_wrong_snapshot_metadata(meta):
     wrong_metadata = {}
-    snapshot_metadata_t = Table("snapshot_metadata", meta, autoload=True)
-    snapshots_t = Table("snapshots", meta, autoload=True)
+    snapshot_metadata_t = schema.table(meta, "snapshot_metadata")
+    snapshots_t = schema.table(meta, "snapshots")
     metadata_join = snapshot_metadata_t.join(
         snapshots_t, snapshot_metadata_t.c.snapshot_id == snapshots_t.c.id
     )
@@ -514,27 +534,22 @@ def get_wrong_snapshot_metadata(meta):
 
 
 # delete snapshot_metadata still defined where the corresponding snapshot is already deleted
-def fix_wrong_snapshot_metadata(meta, wrong_metadata):
-    snapshot_metadata_t = Table("snapshot_metadata", meta, autoload=True)
-
-    for snapshot_metadata_id in wrong_metadata:
-        log.info("-- action: deleting snapshot_metadata id: %s", snapshot_metadata_id)
-        now = datetime.datetime.utcnow()
-        delete_snapshot_metadata_q = (
-            snapshot_metadata_t.update()
-            .where(snapshot_metadata_t.c.id == snapshot_metadata_id)
-            .values(updated_at=now, deleted_at=now, deleted=1)
-        )
-        delete_snapshot_metadata_q.execute()
+def fix_wrong_snapshot_metadata(meta, wrong_metadata, chunk_size, throttle):
+    snapshot_metadata_t = schema.table(meta, "snapshot_metadata")
+    soft_delete(
+        meta,
+        snapshot_metadata_t,
+        wrong_metadata,
+        chunk_size=chunk_size,
+        throttle=throttle,
+    )
 
 
 # get all the rows with a group_volume_type_mapping still defined where the corresponding group_id is already deleted
 def get_wrong_group_volume_type_mappings(meta):
     wrong_group_volume_type_mappings = {}
-    group_volume_type_mapping_t = Table(
-        "group_volume_type_mapping", meta, autoload=True
-    )
-    groups_t = Table("groups", meta, autoload=True)
+    group_volume_type_mapping_t = schema.table(meta, "group_volume_type_mapping")
+    groups_t = schema.table(meta, "groups")
     group_volume_type_mapping_join = group_volume_type_mapping_t.join(
         groups_t, group_volume_type_mapping_t.c.group_id == groups_t.c.id
     )
@@ -565,26 +580,18 @@ def get_wrong_group_volume_type_mappings(meta):
 
 # delete group_volume_type_mapping still defined where the corresponding groupid is already deleted
 def fix_wrong_group_volume_type_mappings(
-    meta, wrong_group_volume_type_mappings, fix_limit
+    meta, wrong_group_volume_type_mappings, fix_limit, chunk_size, throttle
 ):
     if len(wrong_group_volume_type_mappings) <= int(fix_limit):
-        group_volume_type_mapping_t = Table(
-            "group_volume_type_mapping", meta, autoload=True
+        group_volume_type_mapping_t = schema.table(meta, "group_volume_type_mapping")
+        soft_delete(
+            meta,
+            group_volume_type_mapping_t,
+            wrong_group_volume_type_mappings,
+            chunk_size=chunk_size,
+            throttle=throttle,
         )
 
-        for group_volume_type_mapping_id in wrong_group_volume_type_mappings:
-            log.info(
-                "-- action: deleting group_volume_type_mapping id: %s",
-                group_volume_type_mapping_id,
-            )
-            now = datetime.datetime.utcnow()
-            delete_group_volume_type_mapping_q = (
-                group_volume_type_mapping_t.update()
-                .where(group_volume_type_mapping_t.c.id == group_volume_type_mapping_id)
-                .values(updated_at=now, deleted_at=now, deleted=1)
-            )
-            delete_group_volume_type_mapping_q.execute()
-
     else:
         log.warn(
             "- PLEASE CHECK MANUALLY - too many (more than %s) wrong group_volume_type_mappings - denying to fix them automatically",
@@ -596,7 +603,7 @@ def fix_wrong_group_volume_type_mappings(
 def get_missing_deleted_at(meta, table_names):
     missing_deleted_at = {}
     for t in table_names:
-        a_table_t = Table(t, meta, autoload=True)
+        a_table_t = schema.table(meta, t)
         a_table_select_deleted_at_q = a_table_t.select().where(
             and_(a_table_t.c.deleted == 1, a_table_t.c.deleted_at is None)
         )
@@ -610,7 +617,7 @@ def get_missing_deleted_at(meta, table_names):
 def fix_missing_deleted_at(meta, table_names):
     now = datetime.datetime.utcnow()
     for t in table_names:
-        a_table_t = Table(t, meta, autoload=True)
+        a_table_t = schema.table(meta, t)
 
         log.info(
             "- action: fixing columns with missing deleted_at times in the %s table", t
@@ -626,8 +633,8 @@ def fix_missing_deleted_at(meta, table_names):
 # get all the rows with a service still defined where the corresponding volume is already deleted
 def get_deleted_services_still_used_in_volumes(meta):
     deleted_services_still_used_in_volumes = {}
-    services_t = Table("services", meta, autoload=True)
-    volumes_t = Table("volumes", meta, autoload=True)
+    services_t = schema.table(meta, "services")
+    volumes_t = schema.table(meta, "volumes")
     services_volumes_join = services_t.join(
         volumes_t, services_t.c.uuid == volumes_t.c.service_uuid
     )
@@ -658,7 +665,7 @@ def get_deleted_services_still_used_in_volumes(meta):
 def fix_deleted_services_still_used_in_volumes(
     meta, deleted_services_still_used_in_volumes
 ):
-    services_t = Table("services", meta, autoload=True)
+    services_t = schema.table(meta, "services")
 
     for (
         deleted_services_still_used_in_volumes_id
@@ -720,85 +727,112 @@ def get_db_url(config_file):
     return db_url
 
 
-# cmdline handling
-def parse_cmdline_args():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--config", default="./cinder.conf", help="configuration file")
-    parser.add_argument(
-        "--dry-run",
-        action="store_true",
-        help="print only what would be done without actually doing it",
-    )
-    parser.add_argument(
-        "--fix-limit",
-        default=25,
-        help="maximum number of inconsistencies to fix automatically - if there are more, automatic fixing is denied",
+# the checks for rows still defined where the referenced row is already deleted
+# as (table, column, referenced table, limited by --fix-limit)
+REFERENCE_CHECKS = [
+    ("volume_admin_metadata", "volume_id", "volumes", False),
+    ("volume_glance_metadata", "volume_id", "volumes", False),
+    ("volume_glance_metadata", "snapshot_id", "snapshots", False),
+    ("volume_metadata", "volume_id", "volumes", False),
+    ("volume_attachment", "volume_id", "volumes", True),
+    ("snapshot_metadata", "snapshot_id", "snapshots", False),
+    ("group_volume_type_mapping", "group_id", "groups", True),
+]
+
+
+# return the join and the where clause of a reference check
+def get_wrong_references_clause(meta, table_name, column, referenced_table_name):
+    table_t = schema.table(meta, table_name)
+    referenced_t = schema.table(meta, referenced_table_name)
+    join = table_t.join(referenced_t, table_t.c[column] == referenced_t.c.id)
+    whereclause = and_(referenced_t.c.deleted == 1, table_t.c.deleted == 0)
+    return table_t, referenced_t, join, whereclause
+
+
+# count the rows still defined where the referenced row is already deleted
+def count_wrong_references(meta, table_name, column, referenced_table_name):
+    _, _, join, whereclause = get_wrong_references_clause(
+        meta, table_name, column, referenced_table_name
     )
-    return parser.parse_args()
-
+    count_q = select(columns=[func.count()]).select_from(join).where(whereclause)
+    return count_q.execute().scalar()
 
-def main():
-    try:
-        args = parse_cmdline_args()
-    except Exception as e:
-        log.error("Check command line arguments (%s)", e.strerror)
-
-    # connect to openstack
-    conn = makeOsConnection()
-
-    # connect to the DB
-    db_url = get_db_url(args.config)
-    cinder_session, cinder_metadata, cinder_Base = makeConnection(db_url)
 
-    # fixing volume attachments at no longer existing instances
-    orphan_volume_attachments = get_orphan_volume_attachments(cinder_metadata)
-    nova_instances = get_nova_instances(conn)
-    wrong_orphan_volume_attachments = get_wrong_orphan_volume_attachments(
-        nova_instances, orphan_volume_attachments
+# yield the (id, referenced id) pairs of the rows still defined where the
+# referenced row is already deleted, page by page from a server side cursor
+def stream_wrong_references(
+    meta, table_name, column, referenced_table_name, chunk_size
+):
+    table_t, referenced_t, join, whereclause = get_wrong_references_clause(
+        meta, table_name, column, referenced_table_name
     )
-    if len(wrong_orphan_volume_attachments) != 0:
-        log.info("- orphan volume attachments found:")
-        # print out what we would delete
-        for orphan_volume_attachment_id in wrong_orphan_volume_attachments:
+    wrong_references_q = (
+        select(columns=[table_t.c.id, referenced_t.c.id])
+        .select_from(join)
+        .where(whereclause)
+    )
+
+    with meta.bind.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            wrong_references_q
+        )
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+
+# detect and fix rows referencing deleted rows with flat memory usage, only
+# counting first and then paging through the ids
+def check_wrong_references_streaming(meta, args):
+    for table_name, column, referenced_table_name, limited in REFERENCE_CHECKS:
+        count = count_wrong_references(meta, table_name, column, referenced_table_name)
+        if not count:
             log.info(
-                "-- orphan volume attachment (id in cinder db: %s) for non existent instance in nova: %s",
-                orphan_volume_attachment_id,
-                orphan_volume_attachments[orphan_volume_attachment_id],
+                "- %s entries for %s are consistent", table_name, referenced_table_name
             )
-        if not args.dry_run:
-            log.info("- deleting orphan volume attachment inconsistencies found")
-            fix_wrong_orphan_volume_attachments(
-                cinder_metadata, wrong_orphan_volume_attachments, args.fix_limit
-            )
-    else:
-        log.info("- no orphan volume attachments found")
+            continue
 
-    # fixing possible volumes in state "error-deleting"
-    error_deleting_volumes = get_error_deleting_volumes(cinder_metadata)
-    if len(error_deleting_volumes) != 0:
-        log.info("- volumes in state error_deleting found")
-        # print out what we would delete
-        for error_deleting_volumes_id in error_deleting_volumes:
-            log.info("-- volume id: %s", error_deleting_volumes_id)
-        if not args.dry_run:
-            log.info("- deleting volumes in state error_deleting")
-            fix_error_deleting_volumes(cinder_metadata, error_deleting_volumes)
-    else:
-        log.info("- no volumes in state error_deleting found")
-
-    # fixing possible snapshots in state "error-deleting"
-    error_deleting_snapshots = get_error_deleting_snapshots(cinder_metadata)
-    if len(error_deleting_snapshots) != 0:
-        log.info("- snapshots in state error_deleting found")
-        # print out what we would delete
-        for error_deleting_snapshots_id in error_deleting_snapshots:
-            log.info("-- snapshot id: %s", error_deleting_snapshots_id)
-        if not args.dry_run:
-            log.info("- deleting snapshots in state error_deleting")
-            fix_error_deleting_snapshots(cinder_metadata, error_deleting_snapshots)
-    else:
-        log.info("- no snapshots in state error_deleting found")
+        log.info(
+            "- %d %s inconsistencies for %s found",
+            count,
+            table_name,
+            referenced_table_name,
+        )
+        fix = not args.dry_run
+        if fix and limited and count > int(args.fix_limit):
+            log.warn(
+                "- PLEASE CHECK MANUALLY - too many (more than %s) wrong %s - denying to fix them automatically",
+                str(args.fix_limit),
+                table_name,
+            )
+            fix = False
 
+        table_t = schema.table(meta, table_name)
+        for rows in stream_wrong_references(
+            meta, table_name, column, referenced_table_name, args.chunk_size
+        ):
+            for row_id, referenced_id in rows:
+                log.info(
+                    "-- %s id: %s - deleted %s id: %s",
+                    table_name,
+                    row_id,
+                    referenced_table_name,
+                    referenced_id,
+                )
+            if fix:
+                soft_delete(
+                    meta,
+                    table_t,
+                    [row_id for row_id, _ in rows],
+                    chunk_size=args.chunk_size,
+                    throttle=args.throttle,
+                )
+
+
+# detect and fix rows referencing deleted rows
+def check_wrong_references(cinder_metadata, args):
     # fixing possible wrong admin_metadata entries
     wrong_admin_metadata = get_wrong_volume_admin_metadata(cinder_metadata)
     if len(wrong_admin_metadata) != 0:
@@ -812,7 +846,9 @@ def main():
             )
         if not args.dry_run:
             log.info("- removing volume_admin_metadata inconsistencies found")
-            fix_wrong_volume_admin_metadata(cinder_metadata, wrong_admin_metadata)
+            fix_wrong_volume_admin_metadata(
+                cinder_metadata, wrong_admin_metadata, args.chunk_size, args.throttle
+            )
     else:
         log.info("- volume_admin_metadata entries are consistent")
 
@@ -830,7 +866,7 @@ def main():
         if not args.dry_run:
             log.info("- removing volume_glance_metadata inconsistencies found")
             fix_wrong_volume_glance_metadata_volumes(
-                cinder_metadata, wrong_glance_metadata
+                cinder_metadata, wrong_glance_metadata, args.chunk_size, args.throttle
             )
     else:
         log.info("- volume_glance_metadata entries for volumes are consistent")
@@ -849,7 +885,7 @@ def main():
         if not args.dry_run:
             log.info("- removing volume_glance_metadata inconsistencies found")
             fix_wrong_volume_glance_metadata_snapshots(
-                cinder_metadata, wrong_glance_metadata
+                cinder_metadata, wrong_glance_metadata, args.chunk_size, args.throttle
             )
     else:
         log.info("- volume_glance_metadata entries for snapshots are consistent")
@@ -867,7 +903,9 @@ def main():
             )
         if not args.dry_run:
             log.info("- removing volume_metadata inconsistencies found")
-            fix_wrong_volume_metadata(cinder_metadata, wrong_metadata)
+            fix_wrong_volume_metadata(
+                cinder_metadata, wrong_metadata, args.chunk_size, args.throttle
+            )
     else:
         log.info("- volume_metadata entries are consistent")
 
@@ -885,7 +923,11 @@ def main():
         if not args.dry_run:
             log.info("- removing volume attachment inconsistencies found")
             fix_wrong_volume_attachments(
-                cinder_metadata, wrong_attachments, args.fix_limit
+                cinder_metadata,
+                wrong_attachments,
+                args.fix_limit,
+                args.chunk_size,
+                args.throttle,
             )
     else:
         log.info("- volume attachments are consistent")
@@ -903,7 +945,9 @@ def main():
             )
         if not args.dry_run:
             log.info("- removing snapshot_metadata inconsistencies found")
-            fix_wrong_snapshot_metadata(cinder_metadata, wrong_metadata)
+            fix_wrong_snapshot_metadata(
+                cinder_metadata, wrong_metadata, args.chunk_size, args.throttle
+            )
     else:
         log.info("- snapshot_metadata entries are consistent")
 
@@ -923,11 +967,151 @@ def main():
         if not args.dry_run:
             log.info("- removing group_volume_type_mapping inconsistencies found")
             fix_wrong_group_volume_type_mappings(
-                cinder_metadata, wrong_group_volume_type_mappings, args.fix_limit
+                cinder_metadata,
+                wrong_group_volume_type_mappings,
+                args.fix_limit,
+                args.chunk_size,
+                args.throttle,
             )
     else:
         log.info("- group_volume_type_mappings are consistent")
 
+
+# argparse type of --chunk-size
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not at least 1")
+    return number
+
+
+# argparse type of --throttle
+def non_negative_float(value):
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is negative")
+    return number
+
+
+# cmdline handling
+def parse_cmdline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="./cinder.conf", help="configuration file")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print only what would be done without actually doing it",
+    )
+    parser.add_argument(
+        "--fix-limit",
+        default=25,
+        help="maximum number of inconsistencies to fix automatically - if there are more, automatic fixing is denied",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=positive_int,
+        default=SOFT_DELETE_CHUNK_SIZE,
+        help="number of rows soft deleted in one transaction",
+    )
+    parser.add_argument(
+        "--throttle",
+        type=non_negative_float,
+        default=SOFT_DELETE_THROTTLE,
+        help="seconds to pause between two soft delete transactions",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="count inconsistencies first and page through their ids instead of loading them all at once",
+    )
+    parser.add_argument(
+        "--schema-cache",
+        action="store_true",
+        help="cache the reflected database schema on disk, keyed by the alembic revision",
+    )
+    return parser.parse_args()
+
+
+def main():
+    try:
+        args = parse_cmdline_args()
+    except Exception as e:
+        log.error("Check command line arguments (%s)", e.strerror)
+
+    # connect to openstack
+    conn = makeOsConnection()
+
+    # connect to the DB
+    db_url = get_db_url(args.config)
+    cinder_session, cinder_metadata, cinder_Base = makeConnection(db_url)
+    schema.load(cinder_metadata, TABLE_NAMES, cache=args.schema_cache)
+
+    # fixing volume attachments at no longer existing instances
+    orphan_volume_attachments = get_orphan_volume_attachments(cinder_metadata)
+    nova_instances = get_nova_instances(conn)
+    wrong_orphan_volume_attachments = get_wrong_orphan_volume_attachments(
+        nova_instances, orphan_volume_attachments
+    )
+    if len(wrong_orphan_volume_attachments) != 0:
+        log.info("- orphan volume attachments found:")
+        # print out what we would delete
+        for orphan_volume_attachment_id in wrong_orphan_volume_attachments:
+            log.info(
+                "-- orphan volume attachment (id in cinder db: %s) for non existent instance in nova: %s",
+                orphan_volume_attachment_id,
+                orphan_volume_attachments[orphan_volume_attachment_id],
+            )
+        if not args.dry_run:
+            log.info("- deleting orphan volume attachment inconsistencies found")
+            fix_wrong_orphan_volume_attachments(
+                cinder_metadata,
+                wrong_orphan_volume_attachments,
+                args.fix_limit,
+                args.chunk_size,
+                args.throttle,
+            )
+    else:
+        log.info("- no orphan volume attachments found")
+
+    # fixing possible volumes in state "error-deleting"
+    error_deleting_volumes = get_error_deleting_volumes(cinder_metadata)
+    if len(error_deleting_volumes) != 0:
+        log.info("- volumes in state error_deleting found")
+        # print out what we would delete
+        for error_deleting_volumes_id in error_deleting_volumes:
+            log.info("-- volume id: %s", error_deleting_volumes_id)
+        if not args.dry_run:
+            log.info("- deleting volumes in state error_deleting")
+            fix_error_deleting_volumes(
+                cinder_metadata, error_deleting_volumes, args.chunk_size, args.throttle
+            )
+    else:
+        log.info("- no volumes in state error_deleting found")
+
+    # fixing possible snapshots in state "error-deleting"
+    error_deleting_snapshots = get_error_deleting_snapshots(cinder_metadata)
+    if len(error_deleting_snapshots) != 0:
+        log.info("- snapshots in state error_deleting found")
+        # print out what we would delete
+        for error_deleting_snapshots_id in error_deleting_snapshots:
+            log.info("-- snapshot id: %s", error_deleting_snapshots_id)
+        if not args.dry_run:
+            log.info("- deleting snapshots in state error_deleting")
+            fix_error_deleting_snapshots(
+                cinder_metadata,
+                error_deleting_snapshots,
+                args.chunk_size,
+                args.throttle,
+            )
+    else:
+        log.info("- no snapshots in state error_deleting found")
+
+    # fixing possible rows still referencing already deleted rows
+    if args.stream:
+        check_wrong_references_streaming(cinder_metadata, args)
+    else:
+        check_wrong_references(cinder_metadata, args)
+
     # fixing possible missing deleted_at timestamps in some tables
     # tables which sometimes have missing deleted_at values
     table_names = ["snapshots", "volume_attachment"]
@@ -27,21 +27,29 @@ import datetime
 
 from prettytable import PrettyTable
 from sqlalchemy import and_
+from sqlalchemy import bindparam
 from sqlalchemy import func
 from sqlalchemy import MetaData
 from sqlalchemy import select
-from sqlalchemy import Table
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql.expression import false
 from sqlalchemy.ext.declarative import declarative_base
 
+import schema
+
+# Number of projects whose quota usages are synced in one transaction
+SYNC_BATCH_SIZE = 100
+
+# all tables used by the checks, reflected once at startup
+TABLE_NAMES = ["quota_usages", "snapshots", "volume_types", "volumes"]
+
 
 def get_projects(meta):
     """Return a list of all projects in the database"""
 
     projects = []
-    quota_usages_t = Table("quota_usages", meta, autoload=True)
+    quota_usages_t = schema.table(meta, "quota_usages")
     quota_usages_q = select(columns=[quota_usages_t.c.project_id]).group_by(
         quota_usages_t.c.project_id
     )
@@ -68,25 +76,94 @@ def yn_choice():
             sys.stdout.write("Do you want to sync? [Yes/No/Abort]")
 
 
-def sync_quota_usages_project(meta, project_id, quota_usages_to_sync):
-    """Sync the quota usages of a project from real usages"""
+def sync_quota_usages(meta, quota_usages_to_sync, resource_types, volume_types):
+    """Sync the quota usages of many projects from real usages
+
+    The quota usage rows of the projects are locked first, ordered by id like
+    every other writer does, so cinder-api workers reserving quota at the
+    same time wait instead of racing the sync. The real usages are computed
+    again while the rows are locked, usages that changed since the check are
+    written with their current value and usages that are correct by now are
+    skipped. All corrections are written with one executemany in the same
+    transaction."""
+
+    if not quota_usages_to_sync:
+        return
 
-    print(("Syncing %s", project_id))
     now = datetime.datetime.utcnow()
-    quota_usages_t = Table("quota_usages", meta, autoload=True)
-    for resource, quota in iter(list(quota_usages_to_sync.items())):
-        quota_usages_t.update().where(
+    quota_usages_t = schema.table(meta, "quota_usages")
+    project_ids = sorted(quota_usages_to_sync)
+
+    lock_q = (
+        select(
+            columns=[
+                quota_usages_t.c.project_id,
+                quota_usages_t.c.resource,
+                quota_usages_t.c.in_use,
+            ]
+        )
+        .where(quota_usages_t.c.project_id.in_(project_ids))
+        .order_by(quota_usages_t.c.id)
+        .with_for_update()
+    )
+    update_q = (
+        quota_usages_t.update()
+        .where(
             and_(
-                quota_usages_t.c.project_id == project_id,
-                quota_usages_t.c.resource == resource,
+                quota_usages_t.c.project_id == bindparam("b_project_id"),
+                quota_usages_t.c.resource == bindparam("b_resource"),
             )
-        ).values(updated_at=now, in_use=quota).execute()
+        )
+        .values(updated_at=now, in_use=bindparam("b_in_use"))
+    )
+
+    with meta.bind.begin() as connection:
+        locked = {}
+        for project_id, resource, in_use in connection.execute(lock_q):
+            locked[(project_id, resource)] = in_use
+
+        real_usages = get_real_usages(
+            meta,
+            project_ids,
+            resource_types,
+            volume_types,
+            connection=connection,
+            restrict=True,
+        )
+
+        rows = []
+        for project_id in project_ids:
+            for resource in quota_usages_to_sync[project_id]:
+                real = real_usages[project_id].get(resource, 0)
+                if locked.get((project_id, resource)) == real:
+                    continue
+                rows.append(
+                    {
+                        "b_project_id": project_id,
+                        "b_resource": resource,
+                        "b_in_use": real,
+                    }
+                )
+
+        if rows:
+            connection.execute(update_q, rows)
+
+
+def sync_quota_usages_project(
+    meta, project_id, quota_usages_to_sync, resource_types, volume_types
+):
+    """Sync the quota usages of a project from real usages"""
+
+    print(("Syncing %s", project_id))
+    sync_quota_usages(
+        meta, {project_id: quota_usages_to_sync}, resource_types, volume_types
+    )
 
 
 def get_snapshot_usages_project(meta, project_id):
     """Return the snapshot resource usages of a project"""
 
-    snapshots_t = Table("snapshots", meta, autoload=True)
+    snapshots_t = schema.table(meta, "snapshots")
     snapshots_q = select(
         columns=[
             snapshots_t.c.id,
@@ -103,7 +180,7 @@ def get_snapshot_usages_project(meta, project_id):
 def get_volume_usages_project(meta, project_id):
     """Return the volume resource usages of a project"""
 
-    volumes_t = Table("volumes", meta, autoload=True)
+    volumes_t = schema.table(meta, "volumes")
     volumes_q = select(
         columns=[volumes_t.c.id, volumes_t.c.size, volumes_t.c.volume_type_id],
         whereclause=and_(
@@ -113,10 +190,71 @@ def get_volume_usages_project(meta, project_id):
     return volumes_q.execute()
 
 
+def get_snapshot_usages(meta, project_ids=None, connection=None):
+    """Return the snapshot resource usages of all projects, or of the projects
+    in project_ids, per volume type"""
+
+    snapshots_t = schema.table(meta, "snapshots")
+    whereclause = [snapshots_t.c.deleted == false()]
+    if project_ids is not None:
+        whereclause.append(snapshots_t.c.project_id.in_(project_ids))
+    snapshots_q = select(
+        columns=[
+            snapshots_t.c.project_id,
+            snapshots_t.c.volume_type_id,
+            func.count(),
+            func.coalesce(func.sum(snapshots_t.c.volume_size), 0),
+        ],
+        whereclause=and_(*whereclause),
+        group_by=[snapshots_t.c.project_id, snapshots_t.c.volume_type_id],
+    )
+    if connection is not None:
+        return connection.execute(snapshots_q)
+    return snapshots_q.execute()
+
+
+def get_volume_usages(meta, project_ids=None, connection=None):
+    """Return the volume resource usages of all projects, or of the projects
+    in project_ids, per volume type"""
+
+    volumes_t = schema.table(meta, "volumes")
+    whereclause = [volumes_t.c.deleted == false()]
+    if project_ids is not None:
+        whereclause.append(volumes_t.c.project_id.in_(project_ids))
+    volumes_q = select(
+        columns=[
+            volumes_t.c.project_id,
+            volumes_t.c.volume_type_id,
+            func.count(),
+            func.coalesce(func.sum(volumes_t.c.size), 0),
+        ],
+        whereclause=and_(*whereclause),
+        group_by=[volumes_t.c.project_id, volumes_t.c.volume_type_id],
+    )
+    if connection is not None:
+        return connection.execute(volumes_q)
+    return volumes_q.execute()
+
+
+def get_quota_usages(meta):
+    """Return the quota usages of all projects"""
+
+    quota_usages_t = schema.table(meta, "quota_usages")
+    quota_usages_q = select(
+        columns=[
+            quota_usages_t.c.project_id,
+            quota_usages_t.c.resource,
+            quota_usages_t.c.in_use,
+        ],
+        whereclause=quota_usages_t.c.deleted == false(),
+    )
+    return quota_usages_q.execute()
+
+
 def get_quota_usages_project(meta, project_id):
     """Return the quota usages of a project"""
 
-    quota_usages_t = Table("quota_usages", meta, autoload=True)
+    quota_usages_t = schema.table(meta, "quota_usages")
     quota_usages_q = select(
         columns=[quota_usages_t.c.resource, quota_usages_t.c.in_use],
         whereclause=and_(
@@ -131,7 +269,7 @@ def get_resource_types(meta, project_id):
     """Return a list of all resource types"""
 
     types = []
-    quota_usages_t = Table("quota_usages", meta, autoload=True)
+    quota_usages_t = schema.table(meta, "quota_usages")
     resource_types_q = select(
         columns=[quota_usages_t.c.resource, func.count()],
         whereclause=quota_usages_t.c.deleted == false(),
@@ -146,7 +284,7 @@ def get_volume_types(meta, project_id):
     """Return a dict with volume type id to name mapping"""
 
     types = {}
-    volume_types_t = Table("volume_types", meta, autoload=True)
+    volume_types_t = schema.table(meta, "volume_types")
     volume_types_q = select(
         columns=[volume_types_t.c.id, volume_types_t.c.name],
         whereclause=volume_types_t.c.deleted == false(),
@@ -156,6 +294,94 @@ def get_volume_types(meta, project_id):
     return types
 
 
+def get_real_usages(
+    meta, project_ids, resource_types, volume_types, connection=None, restrict=False
+):
+    """Return a dict with the real resource usages per project in project_ids,
+    with restrict only the usages of these projects are queried"""
+
+    real_usages = {}
+    for project_id in project_ids:
+        real_usages[project_id] = dict.fromkeys(resource_types, 0)
+
+    query_ids = project_ids if restrict else None
+    for prefix, usages in [
+        ("volumes", get_volume_usages(meta, query_ids, connection)),
+        ("snapshots", get_snapshot_usages(meta, query_ids, connection)),
+    ]:
+        for project_id, type_id, count, size in usages:
+            if project_id not in real_usages:
+                continue
+            usage = real_usages[project_id]
+            for resource, value in [
+                (prefix, count),
+                (prefix + "_" + volume_types[type_id], count),
+                ("gigabytes", size),
+                ("gigabytes_" + volume_types[type_id], size),
+            ]:
+                usage[resource] = usage.get(resource, 0) + int(value)
+
+    return real_usages
+
+
+def check_all_projects(meta, args, resource_types, volume_types):
+    """Check and sync the quota usages of all projects in one pass"""
+
+    # get the quota usage of all projects
+    quota_usages = {}
+    for project_id, resource, in_use in get_quota_usages(meta):
+        quota_usages.setdefault(project_id, {})[resource] = in_use
+
+    # get the real usage of all projects, only projects with quota usages
+    # can be synced
+    real_usages = get_real_usages(
+        meta, list(quota_usages), resource_types, volume_types
+    )
+
+    # prepare the output
+    ptable = PrettyTable(["Project ID", "Resource", "Quota -> Real", "Sync Status"])
+
+    # find discrepancies between quota usage and real usage
+    quota_usages_to_sync = {}
+    for project_id in sorted(quota_usages):
+        for resource in resource_types:
+            if resource not in quota_usages[project_id]:
+                continue
+            quota = quota_usages[project_id][resource]
+            real = real_usages[project_id][resource]
+            if real != quota:
+                quota_usages_to_sync.setdefault(project_id, {})[resource] = real
+                ptable.add_row(
+                    [
+                        project_id,
+                        resource,
+                        str(quota) + " -> " + str(real),
+                        "\033[1m\033[91mMISMATCH\033[0m",
+                    ]
+                )
+
+    print(
+        "Checked %d projects, %d projects with mismatches"
+        % (len(quota_usages), len(quota_usages_to_sync))
+    )
+    if quota_usages_to_sync:
+        print(ptable)
+
+    # sync the quota with the real usage
+    if quota_usages_to_sync and not args.nosync and (args.sync or yn_choice()):
+        project_ids = sorted(quota_usages_to_sync)
+        for i in range(0, len(project_ids), SYNC_BATCH_SIZE):
+            end = i + SYNC_BATCH_SIZE
+            batch = project_ids[i:end]
+            print("Syncing %d projects" % len(batch))
+            sync_quota_usages(
+                meta,
+                {project_id: quota_usages_to_sync[project_id] for project_id in batch},
+                resource_types,
+                volume_types,
+            )
+
+
 def makeConnection(db_url):
     """Establish a database connection and return the handle"""
 
@@ -196,6 +422,11 @@ def parse_cmdline_args():
         action="store_true",
         help="always sync resources (no interactive check)",
     )
+    parser.add_argument(
+        "--schema_cache",
+        action="store_true",
+        help="cache the reflected database schema on disk, keyed by the alembic revision",
+    )
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
         "--list_projects",
@@ -203,6 +434,11 @@ def parse_cmdline_args():
         help="get a list of all projects in the database",
     )
     group.add_argument("--project_id", type=str, help="project to check")
+    group.add_argument(
+        "--all_projects",
+        action="store_true",
+        help="check all projects in the database in one pass",
+    )
     return parser.parse_args()
 
 
@@ -215,6 +451,7 @@ def main():
     # connect to the DB
     db_url = get_db_url(args.config)
     cinder_session, cinder_metadata, cinder_Base = makeConnection(db_url)
+    schema.load(cinder_metadata, TABLE_NAMES, cache=args.schema_cache)
 
     # get the volume types
     volume_types = get_volume_types(cinder_metadata, args.project_id)
@@ -229,6 +466,10 @@ def main():
             print(p)
         sys.exit(0)
 
+    if args.all_projects:
+        check_all_projects(cinder_metadata, args, resource_types, volume_types)
+        sys.exit(0)
+
     # check a single project
     #
     print(("Checking " + args.project_id + " ..."))
@@ -294,7 +535,11 @@ def main():
     # sync the quota with the real usage
     if quota_usages_to_sync and not args.nosync and (args.sync or yn_choice()):
         sync_quota_usages_project(
-            cinder_metadata, args.project_id, quota_usages_to_sync
+            cinder_metadata,
+            args.project_id,
+            quota_usages_to_sync,
+            resource_types,
+            volume_types,
         )
 
 
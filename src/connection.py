@@ -0,0 +1,22 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Connections to the cloud for worker threads. The worker threads do not
+# share the HTTP session, each one holds its own connection to the cloud.
+
+import threading
+
+import openstack
+from oslo_config import cfg
+
+CONF = cfg.CONF
+
+local = threading.local()
+
+
+def get_cloud():
+    """Return the connection of the current thread to the cloud in
+    CONF.cloud, the connection is opened on first use"""
+
+    if not hasattr(local, "cloud"):
+        local.cloud = openstack.connect(cloud=CONF.cloud)
+    return local.cloud
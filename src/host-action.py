@@ -1,6 +1,8 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import time
+from functools import partial
+from fnmatch import fnmatch
+from itertools import cycle
 import sys
 
 from loguru import logger
@@ -9,6 +11,9 @@ from oslo_config import cfg
 from tabulate import tabulate
 from prompt_toolkit import prompt
 
+import inventory
+from waiter import MigrationWaiter, ServerScheduler, ServerWaiter, Step
+
 PROJECT_NAME = "host-action"
 CONF = cfg.CONF
 opts = [
@@ -21,10 +26,38 @@ opts = [
     cfg.StrOpt("cloud", help="Cloud name in clouds.yaml", default="service"),
     cfg.StrOpt("host", help="Compute node", default=""),
     cfg.StrOpt("input", help="Additional input", default=""),
+    cfg.ListOpt("hosts", help="Compute nodes to drain with --action drain", default=[]),
+    cfg.StrOpt(
+        "host-pattern",
+        help="Shell-style pattern of compute nodes to drain with --action drain, e.g. 'compute-1*'",
+        default=None,
+    ),
+    cfg.IntOpt(
+        "wave-size",
+        help="Number of compute nodes drained at once",
+        default=1,
+        min=1,
+    ),
+    cfg.ListOpt(
+        "targets",
+        help="Compute nodes the live migrations are spread across, the nova scheduler chooses when empty",
+        default=[],
+    ),
+    cfg.IntOpt(
+        "parallel",
+        help="Number of servers stopped, evacuated, started or live migrated at once",
+        default=10,
+        min=1,
+    ),
 ]
 CONF.register_cli_opts(opts)
 CONF(sys.argv[1:], project=PROJECT_NAME)
 
+TIMEOUT_STOP_SERVER = 300
+TIMEOUT_START_SERVER = 300
+TIMEOUT_EVACUATE_SERVER = 900
+TIMEOUT_LIVE_MIGRATE_SERVER = 3600
+
 if CONF.debug:
     level = "DEBUG"
 else:
@@ -38,12 +71,178 @@ log_fmt = (
 logger.remove()
 logger.add(sys.stderr, format=log_fmt, level=level, colorize=True)
 
+# --input is the single target host of earlier versions
+next_target = cycle(CONF.targets or [CONF.input or None]).__next__
+
+
+def live_migrate(server_id):
+    target = next_target()
+    logger.info(
+        f"Target of server {server_id} is {target or 'chosen by the scheduler'}"
+    )
+    cloud.compute.live_migrate_server(server_id, host=target, block_migration="auto")
+
+
+def drain():
+    """Live migrate the servers of all matching compute nodes away, wave by
+    wave. Only the compute nodes of the current wave are disabled, they are
+    enabled again after their wave and are targets of the next waves. Already
+    disabled services stay disabled and drained compute nodes are skipped, so
+    an interrupted drain is resumed by running it again."""
+
+    all_services = list(cloud.compute.services(binary="nova-compute"))
+    services = [
+        service
+        for service in all_services
+        if service.host in CONF.hosts
+        or (CONF.host_pattern and fnmatch(service.host, CONF.host_pattern))
+    ]
+    hosts = sorted(service.host for service in services)
+
+    # one listing of all servers instead of one per compute node
+    servers = {host: [] for host in hosts}
+    # the servers are migrated away, they are never listed from the cache
+    for server in inventory.listing(
+        "compute.servers", cloud.compute.servers, cache=False, all_projects=True
+    ):
+        if server.compute_host in servers:
+            servers[server.compute_host].append(server)
+
+    print(
+        tabulate(
+            [
+                [
+                    service.host,
+                    service.status,
+                    len(servers[service.host]),
+                    len([1 for x in servers[service.host] if x.status == "ACTIVE"]),
+                ]
+                for service in sorted(services, key=lambda x: x.host)
+            ],
+            headers=["Host", "Service", "Servers", "Active servers"],
+            tablefmt="psql",
+        )
+    )
+
+    if not hosts:
+        logger.info("No matching compute nodes")
+        return
+
+    # compute nodes without servers are already drained
+    waves = []
+    for host in hosts:
+        if not servers[host]:
+            continue
+        if not waves or len(waves[-1]) >= CONF.wave_size:
+            waves.append([])
+        waves[-1].append(host)
+
+    # without explicit targets the scheduler needs an enabled compute node
+    # outside of every wave
+    if not CONF.targets and not CONF.input:
+        for wave in waves:
+            if not [
+                service
+                for service in all_services
+                if service.status == "enabled" and service.host not in wave
+            ]:
+                logger.error(
+                    f"No enabled compute node left while draining {', '.join(wave)}, use --targets"
+                )
+                sys.exit(1)
+
+    if not CONF.yes:
+        answer = prompt(f"Disable and drain {len(hosts)} compute nodes [yes/no]: ")
+        if answer not in ["yes", "y"]:
+            return
+
+    waiter = MigrationWaiter(cloud)
+    for number, wave in enumerate(waves, 1):
+        logger.info(f"Draining wave {number} of {len(waves)}: {', '.join(wave)}")
+
+        disabled = [
+            service
+            for service in services
+            if service.host in wave and service.status != "disabled"
+        ]
+        for service in disabled:
+            logger.info(
+                f"Disabling nova-compute binary @ {service.host} ({service.id})"
+            )
+            cloud.compute.disable_service(
+                service=service.id,
+                host=service.host,
+                binary="nova-compute",
+                disabled_reason="MAINTENANCE",
+            )
+
+        scheduler = ServerScheduler(waiter, CONF.parallel)
+        for host in wave:
+            for server in servers[host]:
+                if server.status not in ["ACTIVE"]:
+                    logger.info(
+                        f"{server.id} ({server.name}) in status {server.status} on {host} cannot be live migrated"
+                    )
+                    continue
+                scheduler.add(
+                    server.id,
+                    [
+                        Step(
+                            "Live migrating server",
+                            partial(live_migrate, server.id),
+                            "completed",
+                            TIMEOUT_LIVE_MIGRATE_SERVER,
+                        )
+                    ],
+                )
+        migrated = scheduler.run()
+
+        print(
+            tabulate(
+                [
+                    [host, server.id, server.name, migrated.get(server.id, "SKIPPED")]
+                    for host in wave
+                    for server in servers[host]
+                ],
+                headers=["Host", "ID", "Name", "Live migration"],
+                tablefmt="psql",
+            )
+        )
+
+        for service in disabled:
+            logger.info(f"Enabling nova-compute binary @ {service.host} ({service.id})")
+            cloud.compute.enable_service(
+                service=service.id, host=service.host, binary="nova-compute"
+            )
+
+
 # Connect to the OpenStack environment
 cloud = openstack.connect(cloud=CONF.cloud)
 
+if CONF.action == "drain":
+    if not CONF.hosts and not CONF.host_pattern:
+        logger.error("--action drain requires --hosts or --host-pattern")
+        sys.exit(1)
+    if CONF.host or CONF.enable:
+        logger.error("--action drain cannot be combined with --host or --enable")
+        sys.exit(1)
+    drain()
+    sys.exit(0)
+elif CONF.hosts or CONF.host_pattern:
+    logger.error("--hosts and --host-pattern require --action drain")
+    sys.exit(1)
+
 result = []
 
-for server in cloud.compute.servers(all_projects=True, host=CONF.host):
+# The listing is only cached when it is shown, the servers of an action are
+# listed again.
+for server in inventory.listing(
+    "compute.servers",
+    cloud.compute.servers,
+    cache=not CONF.action,
+    all_projects=True,
+    host=CONF.host,
+):
     result.append([server.id, server.name, server.status])
 
 print(
@@ -77,8 +276,13 @@ if CONF.action:
         if not CONF.yes:
             answer = prompt(f"Evacuate all servers on host {CONF.host} [yes/no]: ")
 
-        start = []
         if answer in ["yes", "y"]:
+            waiter = ServerWaiter(cloud)
+
+            # stop all active servers first, the evacuation requires a forced
+            # down compute service
+            scheduler = ServerScheduler(waiter, CONF.parallel)
+            start = []
             for server in result:
                 if server[2] not in ["ACTIVE", "SHUTOFF"]:
                     logger.info(
@@ -86,20 +290,19 @@ if CONF.action:
                     )
                     continue
                 if server[2] in ["ACTIVE"]:
-                    logger.info(f"Stopping server {server[0]}")
-                    start.append(str(server[0]))
-                    cloud.compute.stop_server(server[0])
-                    inner_wait = True
-                    while inner_wait:
-                        time.sleep(2)
-                        s = cloud.compute.get_server(server[0])
-                        if s.status not in ["SHUTOFF"]:
-                            logger.info(
-                                f"Stopping of {server[0]} ({server[1]}) is still in progress"
+                    start.append(server[0])
+                    scheduler.add(
+                        server[0],
+                        [
+                            Step(
+                                "Stopping server",
+                                partial(cloud.compute.stop_server, server[0]),
+                                "SHUTOFF",
+                                TIMEOUT_STOP_SERVER,
                             )
-                            inner_wait = True
-                        else:
-                            inner_wait = False
+                        ],
+                    )
+            stopped = scheduler.run()
 
             services = cloud.compute.services(
                 **{"host": CONF.host, "binary": "nova-compute"}
@@ -112,30 +315,57 @@ if CONF.action:
                 service=service.id, host=CONF.host, binary="nova-compute"
             )
 
+            scheduler = ServerScheduler(waiter, CONF.parallel)
             for server in result:
-                if server[2] in ["ACTIVE", "SHUTOFF"]:
-                    logger.info(f"Evacuating server {server[0]}")
-                    cloud.compute.evacuate_server(server[0], host=CONF.input)
-
-            logger.info("Waiting 60 seconds")
-            time.sleep(60)
-
-            for server in start:
-                logger.info(f"Starting server {server}")
-                cloud.compute.start_server(server)
-                inner_wait = True
-                while inner_wait:
-                    time.sleep(2)
-                    s = cloud.compute.get_server(server[0])
-                    if s.status not in ["ACTIVE"]:
-                        logger.info(
-                            f"Starting of {server[0]} ({server[1]}) is still in progress"
+                if server[2] not in ["ACTIVE", "SHUTOFF"]:
+                    continue
+                if server[0] in start and stopped.get(server[0]) != "DONE":
+                    logger.warning(
+                        f"{server[0]} ({server[1]}) was not stopped and is not evacuated"
+                    )
+                    continue
+
+                steps = [
+                    Step(
+                        "Evacuating server",
+                        partial(
+                            cloud.compute.evacuate_server, server[0], host=CONF.input
+                        ),
+                        "SHUTOFF",
+                        TIMEOUT_EVACUATE_SERVER,
+                        source=CONF.host,
+                    )
+                ]
+                if server[0] in start:
+                    steps.append(
+                        Step(
+                            "Starting server",
+                            partial(cloud.compute.start_server, server[0]),
+                            "ACTIVE",
+                            TIMEOUT_START_SERVER,
                         )
-                        inner_wait = True
-                    else:
-                        inner_wait = False
+                    )
+                scheduler.add(server[0], steps)
+            evacuated = scheduler.run()
+
+            print(
+                tabulate(
+                    [
+                        [
+                            server[0],
+                            server[1],
+                            stopped.get(server[0], ""),
+                            evacuated.get(server[0], ""),
+                        ]
+                        for server in result
+                    ],
+                    headers=["ID", "Name", "Stop", "Evacuation"],
+                    tablefmt="psql",
+                )
+            )
 
     elif CONF.action == "live-migrate":
+        scheduler = ServerScheduler(MigrationWaiter(cloud), CONF.parallel)
         for server in result:
             if server[2] not in ["ACTIVE"]:
                 logger.info(
@@ -149,25 +379,33 @@ if CONF.action:
                 )
 
             if answer in ["yes", "y"]:
-                logger.info(f"Live migrating server {server[0]}")
-                cloud.compute.live_migrate_server(
-                    server[0], host=CONF.input, block_migration="auto"
+                scheduler.add(
+                    server[0],
+                    [
+                        Step(
+                            "Live migrating server",
+                            partial(live_migrate, server[0]),
+                            "completed" if CONF.wait else None,
+                            TIMEOUT_LIVE_MIGRATE_SERVER,
+                        )
+                    ],
                 )
+        migrated = scheduler.run()
 
-                if CONF.wait:
-                    inner_wait = True
-                    while inner_wait:
-                        time.sleep(2)
-                        s = cloud.compute.get_server(server[0])
-                        if s.status in ["MIGRATING"]:
-                            logger.info(
-                                f"Live migration of {server[0]} ({server[1]}) is still in progress"
-                            )
-                            inner_wait = True
-                        else:
-                            inner_wait = False
+        print(
+            tabulate(
+                [
+                    [server[0], server[1], migrated[server[0]]]
+                    for server in result
+                    if server[0] in migrated
+                ],
+                headers=["ID", "Name", "Live migration"],
+                tablefmt="psql",
+            )
+        )
 
     elif CONF.action == "stop":
+        scheduler = ServerScheduler(ServerWaiter(cloud), CONF.parallel)
         for server in result:
             if server[2] not in ["ACTIVE"]:
                 logger.info(
@@ -179,8 +417,18 @@ if CONF.action:
                 answer = prompt(f"Stop server {server[0]} ({server[1]}) [yes/no]: ")
 
             if answer in ["yes", "y"]:
-                logger.info(f"Stopping server {server[0]}")
-                cloud.compute.stop_server(server[0])
+                scheduler.add(
+                    server[0],
+                    [
+                        Step(
+                            "Stopping server",
+                            partial(cloud.compute.stop_server, server[0]),
+                            "SHUTOFF" if CONF.wait else None,
+                            TIMEOUT_STOP_SERVER,
+                        )
+                    ],
+                )
+        scheduler.run()
     else:
         logger.error(f"Unknown action {CONF.action}")
 
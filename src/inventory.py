@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# On-disk cache of resource listings, shared by the tools. A listing is keyed
+# by the cloud name, the resource type and the query parameters and is reused
+# as long as it is not older than --cache-ttl seconds.
+
+from contextlib import closing
+from importlib import import_module
+import json
+import os
+import sqlite3
+import time
+
+from loguru import logger
+from openstack import resource
+from oslo_config import cfg
+
+from cachedir import CACHE_DIRECTORY
+
+CONF = cfg.CONF
+opts = [
+    cfg.IntOpt(
+        "cache-ttl",
+        help="Reuse cached resource listings up to this age in seconds, 0 disables the cache",
+        default=0,
+        min=0,
+    ),
+    cfg.BoolOpt(
+        "refresh",
+        help="Ignore cached resource listings and fetch them again",
+        default=False,
+    ),
+]
+CONF.register_cli_opts(opts)
+
+CACHE_FILE = os.path.join(CACHE_DIRECTORY, "inventory.sqlite")
+
+
+def connect():
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    database = sqlite3.connect(CACHE_FILE, timeout=30)
+    database.execute(
+        "CREATE TABLE IF NOT EXISTS listing ("
+        "cloud TEXT, name TEXT, query TEXT, created_at REAL, resources TEXT, "
+        "PRIMARY KEY (cloud, name, query))"
+    )
+    return database
+
+
+def dump(item):
+    if isinstance(item, resource.Resource):
+        cls = type(item)
+        return {
+            "class": f"{cls.__module__}:{cls.__qualname__}",
+            "attrs": item.to_dict(computed=False),
+        }
+    return {"class": None, "attrs": item}
+
+
+def load(item):
+    if not item["class"]:
+        return item["attrs"]
+    module, name = item["class"].split(":")
+    cls = getattr(import_module(module), name)
+    return cls.existing(**item["attrs"])
+
+
+def listing(name, lister, cache=True, **query):
+    """Return the resources of a listing, from the cache if possible
+
+    Listings that resources are acted on without checking them again are
+    requested with cache=False."""
+
+    if not CONF.cache_ttl or not cache:
+        return list(lister(**query))
+
+    key = (CONF.cloud, name, json.dumps(query, sort_keys=True, default=str))
+
+    with closing(connect()) as database:
+        row = database.execute(
+            "SELECT created_at, resources FROM listing "
+            "WHERE cloud = ? AND name = ? AND query = ?",
+            key,
+        ).fetchone()
+
+    if row and not CONF.refresh:
+        age = time.time() - row[0]
+        if age <= CONF.cache_ttl:
+            logger.debug(f"Using cached listing {name} {key[2]} ({int(age)}s old)")
+            return [load(item) for item in json.loads(row[1])]
+
+    resources = list(lister(**query))
+
+    with closing(connect()) as database, database:
+        database.execute(
+            "REPLACE INTO listing VALUES (?, ?, ?, ?, ?)",
+            key
+            + (
+                time.time(),
+                json.dumps([dump(item) for item in resources], default=str),
+            ),
+        )
+
+    return resources
@@ -1,13 +1,18 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+from functools import partial
 import sys
 from time import sleep
 
 from loguru import logger
 import openstack
+from openstack.load_balancer.v2.load_balancer import LoadBalancer
 from oslo_config import cfg
 from prompt_toolkit import prompt
-import pymysql
+from tabulate import tabulate
+
+from database import Database
+from waiter import AmphoraWaiter, FailoverScheduler
 
 PROJECT_NAME = "loadbalancer"
 CONF = cfg.CONF
@@ -22,6 +27,27 @@ opts = [
         choices=["provisioning_status", "operating_status"],
     ),
     cfg.StrOpt("cloud", help="Cloud name in clouds.yaml", default="service"),
+    cfg.BoolOpt(
+        "bulk",
+        help="Reset and failover all stuck loadbalancers after a single confirmation",
+        default=False,
+    ),
+    cfg.IntOpt(
+        "parallel-failovers",
+        help="Number of loadbalancer failovers running at once in bulk mode",
+        default=4,
+        min=1,
+    ),
+    cfg.BoolOpt(
+        "from-database",
+        help="Discover stuck loadbalancers in the Octavia database instead of the API",
+        default=False,
+    ),
+    cfg.BoolOpt(
+        "list",
+        help="List all stuck loadbalancers, listeners and amphorae from the Octavia database",
+        default=False,
+    ),
 ]
 CONF.register_cli_opts(opts)
 CONF(sys.argv[1:], project=PROJECT_NAME)
@@ -29,6 +55,30 @@ CONF(sys.argv[1:], project=PROJECT_NAME)
 SLEEP_WAIT_FOR_AMPHORA_BOOT = 5
 TIMEOUT_WAIT_FOR_AMPHORA_BOOT = 120
 
+RETRY_FAILOVER_LOADBALANCER = 3
+
+STUCK_STATUS = ("PENDING_CREATE", "PENDING_UPDATE", "PENDING_DELETE", "ERROR")
+
+# All stuck objects in one query, each part is covered by the indexes on the
+# status columns. Deleted objects are never stuck, not even with an ERROR
+# operating status.
+QUERY_STUCK = (
+    "SELECT 'load_balancer' AS type, id, id AS load_balancer_id, "
+    "provisioning_status, operating_status FROM load_balancer "
+    "WHERE (provisioning_status IN %(status)s OR operating_status = 'ERROR') "
+    "AND provisioning_status != 'DELETED' "
+    "UNION ALL "
+    "SELECT 'listener' AS type, id, load_balancer_id, "
+    "provisioning_status, operating_status FROM listener "
+    "WHERE (provisioning_status IN %(status)s OR operating_status = 'ERROR') "
+    "AND provisioning_status != 'DELETED' "
+    "UNION ALL "
+    "SELECT 'amphora' AS type, id, load_balancer_id, "
+    "status AS provisioning_status, NULL AS operating_status FROM amphora "
+    "WHERE status IN %(status)s AND status != 'DELETED' "
+    "ORDER BY load_balancer_id, type"
+)
+
 if CONF.debug:
     level = "DEBUG"
 else:
@@ -82,58 +132,148 @@ def wait_for_amphora_boot(loadbalancer_id):
         sleep(SLEEP_WAIT_FOR_AMPHORA_BOOT)
 
 
-def reset_load_balancer_operating_status(load_balancer):
-    global database
+def reset_load_balancer_operating_status(*load_balancers):
+    database.update(
+        "load_balancer",
+        {"operating_status": "ONLINE"},
+        [load_balancer.id for load_balancer in load_balancers],
+    )
+
+
+def reset_load_balancer_provisioning_status(*load_balancers):
+    database.update(
+        "load_balancer",
+        {"provisioning_status": "ACTIVE"},
+        [load_balancer.id for load_balancer in load_balancers],
+    )
+
+
+def set_error_load_balancer_provisioning_status(*load_balancers):
+    database.update(
+        "load_balancer",
+        {"provisioning_status": "ERROR"},
+        [load_balancer.id for load_balancer in load_balancers],
+    )
+
+
+def list_load_balancers(**filters):
+    if not CONF.from_database:
+        return list(cloud.load_balancer.load_balancers(**filters))
+
+    conditions = " AND ".join(f"{column} = %s" for column in filters)
+    rows = database.select(
+        "SELECT id, name, project_id, provisioning_status, operating_status "
+        f"FROM load_balancer WHERE {conditions}",
+        list(filters.values()),
+    )
+    return [LoadBalancer.existing(**row) for row in rows]
+
+
+def list_stuck():
+    rows = database.select(QUERY_STUCK, {"status": STUCK_STATUS})
+    print(
+        tabulate(
+            [
+                [
+                    row["load_balancer_id"],
+                    row["type"],
+                    row["id"],
+                    row["provisioning_status"],
+                    row["operating_status"],
+                ]
+                for row in rows
+            ],
+            headers=[
+                "Loadbalancer",
+                "Type",
+                "ID",
+                "Provisioning status",
+                "Operating status",
+            ],
+            tablefmt="psql",
+        )
+    )
+
+
+def watch_failover(loadbalancer_id, callback=None):
+    waiter.watch(loadbalancer_id, "BOOTING", TIMEOUT_WAIT_FOR_AMPHORA_BOOT, callback)
 
-    with database.cursor() as cursor:
-        query = f"UPDATE load_balancer SET operating_status = 'ONLINE' WHERE id = '{load_balancer.id}';"
-        logger.debug(query)
-        cursor.execute(query)
-        database.commit()
 
+def bulk(load_balancers, reset):
+    """Reset all load balancers in one batch and fail them over in parallel"""
 
-def reset_load_balancer_provisioning_status(load_balancer):
-    global database
+    if not load_balancers:
+        logger.info("Nothing to do")
+        return
 
-    with database.cursor() as cursor:
-        query = f"UPDATE load_balancer SET provisioning_status = 'ACTIVE' WHERE id = '{load_balancer.id}';"
-        logger.debug(query)
-        cursor.execute(query)
-        database.commit()
+    print(
+        tabulate(
+            [
+                [
+                    load_balancer.id,
+                    load_balancer.name,
+                    load_balancer.provisioning_status,
+                    load_balancer.operating_status,
+                ]
+                for load_balancer in load_balancers
+            ],
+            headers=["ID", "Name", "Provisioning status", "Operating status"],
+            tablefmt="psql",
+        )
+    )
 
+    result = prompt(
+        f"Reset and failover {len(load_balancers)} loadbalancers [yes/no]: "
+    )
+    if result != "yes":
+        return
 
-def set_error_load_balancer_provisioning_status(load_balancer):
-    global database
+    logger.info(f"Resetting {len(load_balancers)} loadbalancers")
+    reset(*load_balancers)
 
-    with database.cursor() as cursor:
-        query = f"UPDATE load_balancer SET provisioning_status = 'ERROR' WHERE id = '{load_balancer.id}';"
-        logger.debug(query)
-        cursor.execute(query)
-        database.commit()
+    scheduler = FailoverScheduler(
+        waiter,
+        watch_failover,
+        CONF.parallel_failovers,
+        retries=RETRY_FAILOVER_LOADBALANCER,
+    )
+    for load_balancer in load_balancers:
+        scheduler.add(
+            load_balancer.id,
+            partial(cloud.load_balancer.failover_load_balancer, load_balancer.id),
+        )
+    results = scheduler.run()
+
+    print(
+        tabulate(
+            [
+                [
+                    load_balancer.id,
+                    load_balancer.name,
+                    results.get(f"loadbalancer {load_balancer.id}", "UNKNOWN"),
+                ]
+                for load_balancer in load_balancers
+            ],
+            headers=["ID", "Name", "Failover"],
+            tablefmt="psql",
+        )
+    )
+
+    if any(result != "DONE" for result in results.values()):
+        sys.exit(1)
 
 
 # Connect to the OpenStack environment
 cloud = openstack.connect(cloud=CONF.cloud)
+waiter = AmphoraWaiter(cloud)
 
 # Connect to the database
-# NOTE: Beautify this
-connection_parts = CONF.connection.split("//")[1]
-db_username = connection_parts.split(":")[0]
-db_password = connection_parts.split(":")[1].split("@")[0]
-db_host = connection_parts.split("@")[1].split(":")[0]
-db_port = int(connection_parts.split("@")[1].split(":")[1].split("/")[0])
-db_database = connection_parts.split("@")[1].split(":")[1].split("/")[1]
-
-database = pymysql.connect(
-    host=db_host,
-    port=db_port,
-    user=db_username,
-    password=db_password,
-    database=db_database,
-    cursorclass=pymysql.cursors.DictCursor,
-)
+database = Database(CONF.connection)
+
+if CONF.list:
+    list_stuck()
 
-if CONF.loadbalancer and CONF.type == "provisioning_status":
+elif CONF.loadbalancer and CONF.type == "provisioning_status":
     load_balancer = cloud.load_balancer.get_load_balancer(CONF.loadbalancer)
 
     logger.info(
@@ -175,10 +315,12 @@ if CONF.loadbalancer and CONF.type == "provisioning_status":
         )
         sys.exit(1)
 
+elif not CONF.loadbalancer and CONF.type == "provisioning_status" and CONF.bulk:
+    load_balancers = list_load_balancers(provisioning_status="PENDING_UPDATE")
+    bulk(load_balancers, reset_load_balancer_provisioning_status)
+
 elif not CONF.loadbalancer and CONF.type == "provisioning_status":
-    load_balancers = cloud.load_balancer.load_balancers(
-        provisioning_status="PENDING_UPDATE"
-    )
+    load_balancers = list_load_balancers(provisioning_status="PENDING_UPDATE")
 
     for load_balancer in load_balancers:
         logger.info(
@@ -216,8 +358,19 @@ elif CONF.loadbalancer and CONF.type == "operating_status":
         sleep(10)  # wait for the octavia API
         wait_for_amphora_boot(load_balancer.id)
 
+elif not CONF.loadbalancer and CONF.type == "operating_status" and CONF.bulk:
+    load_balancers = []
+    for load_balancer in list_load_balancers(operating_status="ERROR"):
+        if load_balancer.provisioning_status != "ACTIVE":
+            logger.warning(
+                f"Skipping {load_balancer.name}, it has to be in provisioning_status ACTIVE"
+            )
+            continue
+        load_balancers.append(load_balancer)
+    bulk(load_balancers, reset_load_balancer_operating_status)
+
 elif not CONF.loadbalancer and CONF.type == "operating_status":
-    load_balancers = cloud.load_balancer.load_balancers(provisioning_status="ERROR")
+    load_balancers = list_load_balancers(provisioning_status="ERROR")
     for load_balancer in load_balancers:
         logger.info(f"Loadbalancer {load_balancer.name} is in operating_status ERROR")
 
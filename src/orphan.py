@@ -1,12 +1,24 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime, timedelta, timezone
+import json
+from operator import attrgetter
+import os
+import sqlite3
 import sys
+from time import sleep
 
 from loguru import logger
 import openstack
 from oslo_config import cfg
 from tabulate import tabulate
-from typing import List
+from typing import Callable, Dict, Optional, Tuple
+
+from cachedir import CACHE_DIRECTORY
+from connection import get_cloud
+import inventory
 
 
 PROJECT_NAME = "orphan"
@@ -14,10 +26,52 @@ CONF = cfg.CONF
 opts = [
     cfg.BoolOpt("debug", help="Enable debug logging", default=False),
     cfg.StrOpt("cloud", help="Cloud name in clouds.yaml", default="service"),
+    cfg.IntOpt(
+        "workers",
+        help="Number of resource listings fetched in parallel",
+        default=8,
+        min=1,
+    ),
+    cfg.IntOpt(
+        "page-size",
+        help="Number of resources requested per page of a listing",
+        default=1000,
+        min=1,
+    ),
+    cfg.StrOpt(
+        "format",
+        help="Output format, jsonl and csv write each orphan as soon as it is found",
+        default="table",
+        choices=["table", "jsonl", "csv"],
+    ),
+    cfg.BoolOpt(
+        "incremental",
+        help="Only list resources changed since the last incremental run",
+        default=False,
+    ),
 ]
 CONF.register_cli_opts(opts)
 CONF(sys.argv[1:], project=PROJECT_NAME)
 
+HEADERS = ["servicename", "resourcename", "resource_id", "project_id", "domain"]
+
+# check() only needs the ID and the owner of a resource. Neutron is the only
+# API that allows to select the returned fields, nova, cinder and glance do
+# not return the owner without the detailed representation.
+NETWORK_FIELDS = ["id", "project_id"]
+
+# Fields of a resource besides the ID and the owner that are kept in the state
+# of incremental runs.
+STATE_FIELDS = {"rbacpolicy": ["target_tenant"], "image": ["visibility"]}
+STATE_FILE = os.path.join(CACHE_DIRECTORY, "orphan.sqlite")
+
+# Changes are requested with this margin in seconds before the start of the
+# last run. A clock skew between this host and the APIs must not be larger.
+WATERMARK_MARGIN = 300
+
+RETRY_IMAGE_MEMBERS = 3
+SLEEP_RETRY_IMAGE_MEMBERS = 1
+
 if CONF.debug:
     level = "DEBUG"
 else:
@@ -32,134 +86,540 @@ logger.remove()
 logger.add(sys.stderr, format=log_fmt, level=level, colorize=True)
 
 
-def check(servicename, resourcename, resources, projects):
-    result = []
+class ProjectIndex:
+    """All projects of the cloud with the domain each project was seen in"""
+
+    def __init__(
+        self, domains: Dict[str, str], last_seen: Optional[Dict[str, str]] = None
+    ):
+        self.domains = domains
+        self.last_seen = last_seen or {}
+        self.ids = frozenset(domains)
+
+    def __contains__(self, project_id) -> bool:
+        return project_id in self.ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def domain(self, project_id) -> Optional[str]:
+        return self.domains.get(project_id) or self.last_seen.get(project_id)
+
+
+def get_project_index(cloud, last_seen=None) -> ProjectIndex:
+    domains: Dict[str, str] = {}
+
+    for domain in cloud.list_domains():
+        if domain.name == "heat_user_domain":
+            continue
+        for project in cloud.list_projects(domain_id=domain.id):
+            domains[project.id] = domain.name
+
+    logger.info(f"Found {len(domains)} projects")
+    return ProjectIndex(domains, last_seen)
+
+
+def key(name):
+    return lambda resource: resource.get(name)
+
+
+# Functions returning the project ID and the resource ID of a resource, per
+# (servicename, resourcename). Resource types without a registration are
+# resolved once from the first resource of their listing.
+EXTRACTORS: Dict[Tuple[str, str], Tuple[Callable, Callable]] = {}
+
+
+def register(servicename, resourcename, project_id, resource_id):
+    EXTRACTORS[(servicename, resourcename)] = (project_id, resource_id)
+
+
+register("neutron", "port", key("project_id"), key("id"))
+register("neutron", "router", key("project_id"), key("id"))
+register("neutron", "network", key("project_id"), key("id"))
+register("neutron", "subnet", key("project_id"), key("id"))
+register("neutron", "floatingip", key("project_id"), key("id"))
+register("neutron", "rbacpolicy", key("project_id"), key("id"))
+register("neutron", "securitygroup", key("project_id"), key("id"))
+register("neutron", "securitygrouprule", key("project_id"), key("id"))
+
+
+def resolve(servicename, resourcename, resource):
+    for name in [
+        "tenant_id",
+        "project_id",
+        "os-vol-tenant-attr:tenant_id",
+        "project",
+        "member_id",
+    ]:
+        if hasattr(resource, name):
+            project_id = attrgetter(name)
+            break
+        if isinstance(resource, dict) and name in resource:
+            project_id = key(name)
+            break
+    else:
+        project_id = key("project_id")
+
+    if hasattr(resource, "id"):
+        resource_id = attrgetter("id")
+    elif resourcename == "imagemember":
+        resource_id = key("member_id")
+    else:
+        resource_id = key("id")
+
+    register(servicename, resourcename, project_id, resource_id)
+    return project_id, resource_id
+
+
+def owners(servicename, resourcename, resources):
+    extractors = EXTRACTORS.get((servicename, resourcename))
 
-    logger.info(f"Checking {servicename} / {resourcename}")
     for resource in resources:
+        if not extractors:
+            extractors = resolve(servicename, resourcename, resource)
+        get_project_id, get_resource_id = extractors
+
         try:
-            if hasattr(resource, "tenant_id"):
-                project_id = resource.tenant_id
-            elif hasattr(resource, "project_id"):
-                project_id = resource.project_id
-            elif hasattr(resource, "os-vol-tenant-attr:tenant_id"):
-                project_id = getattr(resource, "os-vol-tenant-attr:tenant_id")
-            elif hasattr(resource, "project"):
-                project_id = resource.project
-            elif hasattr(resource, "member_id"):
-                project_id = resource.member_id
-            else:
-                project_id = resource.get("project_id")
+            project_id = get_project_id(resource)
         except Exception:
             logger.error("%s resource %s not supported" % (servicename, resourcename))
             logger.debug(dir(resource))
             project_id = None
 
-        if hasattr(resource, "id"):
-            resource_id = resource.id
-        elif resourcename == "imagemember":
-            resource_id = resource.get("member_id")
-        else:
-            resource_id = resource.get("id")
+        yield get_resource_id(resource), project_id, resource
+
+
+def check(servicename, resourcename, owned, projects: ProjectIndex):
+    logger.info(f"Checking {servicename} / {resourcename}")
 
+    for resource_id, project_id, resource in owned:
         logger.debug(f"Checking {resource_id}")
 
         if (project_id and project_id not in projects) or (
             resourcename == "rbacpolicy"
             and resource.get("target_tenant") not in projects
         ):
-            result.append([servicename, resourcename, resource_id, project_id])
+            domain = projects.domain(project_id)
             logger.debug(
-                f"{servicename} - {resourcename}: {resource_id} (project: {project_id})"
+                f"{servicename} - {resourcename}: {resource_id} (project: {project_id}, domain: {domain})"
             )
+            yield [servicename, resourcename, resource_id, project_id, domain]
 
-    return result
 
+class State:
+    """Resource owners and watermarks of the last incremental run and the
+    domains of all projects seen so far"""
 
-# Connect to the OpenStack environment
-cloud = openstack.connect(cloud=CONF.cloud)
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.database = sqlite3.connect(path)
+        self.database.executescript(
+            "CREATE TABLE IF NOT EXISTS watermark ("
+            "cloud TEXT, name TEXT, since TEXT, PRIMARY KEY (cloud, name));"
+            "CREATE TABLE IF NOT EXISTS resource ("
+            "cloud TEXT, name TEXT, id TEXT, project_id TEXT, fields TEXT, "
+            "PRIMARY KEY (cloud, name, id));"
+            "CREATE TABLE IF NOT EXISTS project ("
+            "cloud TEXT, id TEXT, domain TEXT, PRIMARY KEY (cloud, id));"
+        )
 
-domains = [x for x in cloud.list_domains() if x.name != "heat_user_domain"]
+    def watermark(self, servicename, resourcename) -> Optional[str]:
+        row = self.database.execute(
+            "SELECT since FROM watermark WHERE cloud = ? AND name = ?",
+            (CONF.cloud, f"{servicename}.{resourcename}"),
+        ).fetchone()
+        return row[0] if row else None
 
-projects: List[int] = []
-for domain in domains:
-    projects_in_domain = [x.id for x in cloud.list_projects(domain_id=domain.id)]
-    projects = projects + projects_in_domain
+    def set_watermark(self, servicename, resourcename, since):
+        self.database.execute(
+            "REPLACE INTO watermark VALUES (?, ?, ?)",
+            (CONF.cloud, f"{servicename}.{resourcename}", since),
+        )
 
-result = []
+    def rows(self, servicename, resourcename, owned):
+        fields = STATE_FIELDS.get(resourcename, [])
+        for resource_id, project_id, resource in owned:
+            yield (
+                CONF.cloud,
+                f"{servicename}.{resourcename}",
+                resource_id,
+                project_id,
+                json.dumps({field: resource.get(field) for field in fields}),
+            )
 
-result += check(
-    "nova",
-    "server",
-    cloud.compute.servers(all_projects=True),
-    projects,
-)
+    def replace(self, servicename, resourcename, owned):
+        self.database.execute(
+            "DELETE FROM resource WHERE cloud = ? AND name = ?",
+            (CONF.cloud, f"{servicename}.{resourcename}"),
+        )
+        self.database.executemany(
+            "INSERT INTO resource VALUES (?, ?, ?, ?, ?)",
+            self.rows(servicename, resourcename, owned),
+        )
 
-result += check("neutron", "port", cloud.network.ports(), projects)
-result += check("neutron", "router", cloud.network.routers(), projects)
-result += check("neutron", "network", cloud.network.networks(), projects)
-result += check("neutron", "subnet", cloud.network.subnets(), projects)
-result += check(
-    "neutron",
-    "floatingip",
-    cloud.network.ips(),
-    projects,
-)
-result += check(
-    "neutron",
-    "rbacpolicy",
-    cloud.network.rbac_policies(),
-    projects,
-)
-result += check(
-    "neutron",
-    "securitygroup",
-    cloud.network.security_groups(),
-    projects,
-)
-result += check(
-    "neutron",
-    "securitygrouprule",
-    cloud.network.security_group_rules(),
-    projects,
-)
+    def update(self, servicename, resourcename, owned):
+        changed = []
+        for resource_id, project_id, resource in owned:
+            # nova lists the servers deleted since the watermark as well
+            if getattr(resource, "status", None) == "DELETED":
+                self.remove(servicename, resourcename, resource_id)
+            else:
+                changed.append((resource_id, project_id, resource))
+
+        self.database.executemany(
+            "REPLACE INTO resource VALUES (?, ?, ?, ?, ?)",
+            self.rows(servicename, resourcename, changed),
+        )
+        return {resource_id for resource_id, _, _ in changed}
+
+    def remove(self, servicename, resourcename, resource_id):
+        self.database.execute(
+            "DELETE FROM resource WHERE cloud = ? AND name = ? AND id = ?",
+            (CONF.cloud, f"{servicename}.{resourcename}", resource_id),
+        )
 
-result += check("glance", "image", cloud.image.images(), projects)
-for image in [
-    image
-    for image in cloud.image.images()
-    if "visibility" in image and image.visibility == "shared"
-]:
-    result += check(
-        "glance",
-        "imagemember",
-        cloud.image.members(image.id),
-        projects,
+    def records(self, servicename, resourcename):
+        for resource_id, project_id, fields in self.database.execute(
+            "SELECT id, project_id, fields FROM resource WHERE cloud = ? AND name = ?",
+            (CONF.cloud, f"{servicename}.{resourcename}"),
+        ):
+            yield resource_id, project_id, json.loads(fields)
+
+    def domains(self) -> Dict[str, str]:
+        return dict(
+            self.database.execute(
+                "SELECT id, domain FROM project WHERE cloud = ?", (CONF.cloud,)
+            )
+        )
+
+    def save_domains(self, domains: Dict[str, str]):
+        self.database.executemany(
+            "REPLACE INTO project VALUES (?, ?, ?)",
+            [(CONF.cloud, id, domain) for id, domain in domains.items()],
+        )
+
+    def commit(self):
+        self.database.commit()
+
+
+# Every listing is fetched in its own worker thread with its own connection.
+def collect(servicename, resourcename, lister, cache=True):
+    logger.info(f"Listing {servicename} / {resourcename}")
+    if not cache:
+        return list(lister(get_cloud()))
+    return inventory.listing(
+        f"orphan.{servicename}.{resourcename}", lambda: lister(get_cloud())
     )
 
-result += check(
-    "cinder",
-    "volume",
-    cloud.volume.volumes(all_projects=True),
-    projects,
-)
-result += check(
-    "cinder",
-    "volume-snapshot",
-    cloud.volume.snapshots(all_projects=True),
-    projects,
-)
-result += check(
-    "cinder",
-    "backups",
-    cloud.volume.backups(all_projects=True),
-    projects,
-)
 
-print(
-    tabulate(
-        result,
-        headers=["servicename", "resourcename", "resource_id", "project_id"],
-        tablefmt="psql",
+def collect_changes(servicename, resourcename, changes, since):
+    logger.info(f"Listing {servicename} / {resourcename} changed since {since}")
+    return list(changes(get_cloud(), since))
+
+
+def paginate(adapter, url, key, params, **kwargs):
+    while url:
+        response = adapter.get(url, params=params, **kwargs)
+        openstack.exceptions.raise_from_response(response)
+        data = response.json()
+
+        yield from data[key]
+
+        # the next link already contains all query parameters
+        url = None
+        params = None
+        for link in data.get(f"{key}_links", []):
+            if link["rel"] == "next":
+                url = link["href"]
+
+
+def list_network(cloud, path, fields=NETWORK_FIELDS, **filters):
+    # the response key is the path with underscores, e.g. security_group_rules
+    return paginate(
+        cloud.network,
+        f"/{path}",
+        path.replace("-", "_"),
+        {"fields": fields, "limit": CONF.page_size, **filters},
     )
-)
+
+
+def get_network(cloud, path, resource_id):
+    response = cloud.network.get(f"/{path}/{resource_id}", params={"fields": "id"})
+    openstack.exceptions.raise_from_response(response)
+
+
+def list_volume_changes(cloud, since):
+    # filtering on updated_at requires the volume API microversion 3.60
+    return paginate(
+        cloud.volume,
+        "/volumes/detail",
+        "volumes",
+        {"all_tenants": True, "updated_at": f"gte:{since}", "limit": CONF.page_size},
+        microversion="3.60",
+    )
+
+
+def exists(get, resource_id):
+    try:
+        get(get_cloud(), resource_id)
+    except openstack.exceptions.NotFoundException:
+        return False
+    return True
+
+
+def collect_image_members(image_id):
+    attempt = 0
+
+    while True:
+        try:
+            return inventory.listing(
+                "image.members", get_cloud().image.members, image=image_id
+            )
+        except openstack.exceptions.NotFoundException:
+            # the image was deleted after it was listed
+            return []
+        except openstack.exceptions.HttpException as e:
+            if attempt == RETRY_IMAGE_MEMBERS:
+                raise
+            delay = SLEEP_RETRY_IMAGE_MEMBERS * 2**attempt
+            logger.warning(
+                f"Listing members of image {image_id} failed ({e}), retrying in {delay} seconds"
+            )
+            attempt = attempt + 1
+            sleep(delay)
+
+
+LISTINGS = [
+    (
+        "nova",
+        "server",
+        lambda cloud: cloud.compute.servers(all_projects=True, limit=CONF.page_size),
+    ),
+    ("neutron", "port", lambda cloud: list_network(cloud, "ports")),
+    ("neutron", "router", lambda cloud: list_network(cloud, "routers")),
+    ("neutron", "network", lambda cloud: list_network(cloud, "networks")),
+    ("neutron", "subnet", lambda cloud: list_network(cloud, "subnets")),
+    ("neutron", "floatingip", lambda cloud: list_network(cloud, "floatingips")),
+    (
+        "neutron",
+        "rbacpolicy",
+        lambda cloud: list_network(
+            cloud, "rbac-policies", NETWORK_FIELDS + ["target_tenant"]
+        ),
+    ),
+    (
+        "neutron",
+        "securitygroup",
+        lambda cloud: list_network(cloud, "security-groups"),
+    ),
+    (
+        "neutron",
+        "securitygrouprule",
+        lambda cloud: list_network(cloud, "security-group-rules"),
+    ),
+    ("glance", "image", lambda cloud: cloud.image.images(limit=CONF.page_size)),
+    (
+        "cinder",
+        "volume",
+        lambda cloud: cloud.volume.volumes(all_projects=True, limit=CONF.page_size),
+    ),
+    (
+        "cinder",
+        "volume-snapshot",
+        lambda cloud: cloud.volume.snapshots(all_projects=True, limit=CONF.page_size),
+    ),
+    (
+        "cinder",
+        "backups",
+        lambda cloud: cloud.volume.backups(all_projects=True, limit=CONF.page_size),
+    ),
+]
+
+
+def network_changes(path, fields=NETWORK_FIELDS):
+    return (
+        lambda cloud, since: list_network(cloud, path, fields, changed_since=since),
+        lambda cloud, resource_id: get_network(cloud, path, resource_id),
+    )
+
+
+# Listings of the resources changed since a watermark and a function getting a
+# single resource, per (servicename, resourcename). Only these resource types
+# are listed incrementally, all others are listed completely on every run.
+CHANGES = {
+    ("nova", "server"): (
+        lambda cloud, since: cloud.compute.servers(
+            all_projects=True, changes_since=since, limit=CONF.page_size
+        ),
+        lambda cloud, resource_id: cloud.compute.get_server(resource_id),
+    ),
+    ("neutron", "port"): network_changes("ports"),
+    ("neutron", "router"): network_changes("routers"),
+    ("neutron", "network"): network_changes("networks"),
+    ("neutron", "subnet"): network_changes("subnets"),
+    ("neutron", "floatingip"): network_changes("floatingips"),
+    ("neutron", "rbacpolicy"): network_changes(
+        "rbac-policies", NETWORK_FIELDS + ["target_tenant"]
+    ),
+    ("neutron", "securitygroup"): network_changes("security-groups"),
+    ("neutron", "securitygrouprule"): network_changes("security-group-rules"),
+    ("glance", "image"): (
+        lambda cloud, since: cloud.image.images(
+            updated_at=f"gte:{since}", limit=CONF.page_size
+        ),
+        lambda cloud, resource_id: cloud.image.get_image(resource_id),
+    ),
+    ("cinder", "volume"): (
+        list_volume_changes,
+        lambda cloud, resource_id: cloud.volume.get_volume(resource_id),
+    ),
+}
+
+
+def shared_images(owned):
+    return [
+        resource_id
+        for resource_id, _, image in owned
+        if image.get("visibility") == "shared"
+    ]
+
+
+def check_image_members(executor, image_ids, projects):
+    # The members of the shared images are fetched through the same bounded
+    # pool, the image listing is reused for this.
+    logger.info("Listing glance / imagemember")
+    members = [
+        executor.submit(collect_image_members, image_id) for image_id in image_ids
+    ]
+    for future in members:
+        yield from check(
+            "glance",
+            "imagemember",
+            owners("glance", "imagemember", future.result()),
+            projects,
+        )
+
+
+def scan(executor, projects):
+    futures = [
+        (
+            servicename,
+            resourcename,
+            executor.submit(collect, servicename, resourcename, lister),
+        )
+        for servicename, resourcename, lister in LISTINGS
+    ]
+
+    # The listings are checked in the order of LISTINGS, the wall-clock time is
+    # bound by the slowest API and not by the sum of all of them. Checked
+    # listings are dropped to keep the memory usage down.
+    while futures:
+        servicename, resourcename, future = futures.pop(0)
+        owned = owners(servicename, resourcename, future.result())
+        if resourcename == "image":
+            owned = list(owned)
+            images = shared_images(owned)
+        yield from check(servicename, resourcename, owned, projects)
+
+    yield from check_image_members(executor, images, projects)
+
+
+def scan_incremental(executor, projects, state):
+    since = datetime.now(timezone.utc) - timedelta(seconds=WATERMARK_MARGIN)
+
+    futures = []
+    for servicename, resourcename, lister in LISTINGS:
+        watermark = state.watermark(servicename, resourcename)
+        changes = CHANGES.get((servicename, resourcename)) if watermark else None
+        if changes:
+            future = executor.submit(
+                collect_changes, servicename, resourcename, changes[0], watermark
+            )
+        else:
+            # a cached listing may be older than the watermark, changes
+            # between the two would never be seen
+            future = executor.submit(
+                collect, servicename, resourcename, lister, cache=False
+            )
+        futures.append((servicename, resourcename, changes, future))
+
+    # The listings are merged into the state of the last run and the complete
+    # state is checked.
+    while futures:
+        servicename, resourcename, changes, future = futures.pop(0)
+        owned = owners(servicename, resourcename, future.result())
+        if changes:
+            changed = state.update(servicename, resourcename, owned)
+        else:
+            state.replace(servicename, resourcename, owned)
+        state.set_watermark(
+            servicename, resourcename, since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        )
+
+        findings = list(
+            check(
+                servicename,
+                resourcename,
+                state.records(servicename, resourcename),
+                projects,
+            )
+        )
+
+        # Unchanged orphans of the last run may have been deleted in the
+        # meantime. Only nova lists deleted resources, the others are
+        # looked up one by one.
+        if changes:
+            found = [
+                (finding, executor.submit(exists, changes[1], finding[2]))
+                for finding in findings
+                if finding[2] not in changed
+            ]
+            for finding, future in found:
+                if not future.result():
+                    state.remove(servicename, resourcename, finding[2])
+                    findings.remove(finding)
+
+        yield from findings
+
+    images = shared_images(state.records("glance", "image"))
+    yield from check_image_members(executor, images, projects)
+
+    state.commit()
+
+
+def write_table(findings):
+    print(tabulate(list(findings), headers=HEADERS, tablefmt="psql"))
+
+
+def write_jsonl(findings):
+    for finding in findings:
+        print(json.dumps(dict(zip(HEADERS, finding))), flush=True)
+
+
+def write_csv(findings):
+    writer = csv.writer(sys.stdout)
+    writer.writerow(HEADERS)
+    for finding in findings:
+        writer.writerow(finding)
+        sys.stdout.flush()
+
+
+write = {"table": write_table, "jsonl": write_jsonl, "csv": write_csv}
+
+
+# Connect to the OpenStack environment
+cloud = get_cloud()
+
+# The domains of the projects are kept on every run, the domain of a deleted
+# project is the one it was last seen in.
+state = State(STATE_FILE)
+projects = get_project_index(cloud, state.domains())
+state.save_domains(projects.domains)
+state.commit()
+
+if CONF.incremental:
+    with ThreadPoolExecutor(max_workers=CONF.workers) as executor:
+        write[CONF.format](scan_incremental(executor, projects, state))
+else:
+    with ThreadPoolExecutor(max_workers=CONF.workers) as executor:
+        write[CONF.format](scan(executor, projects))
@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Schema registry for the cinder database tools. The needed tables are
+# reflected once per process in one pass. Optionally the reflected schema is
+# pickled to disk, keyed by the Alembic revision of the database, and reused
+# by later runs against the same schema.
+
+import logging
+import os
+import pickle
+
+from sqlalchemy import Table, text
+
+from cachedir import CACHE_DIRECTORY
+
+log = logging.getLogger(__name__)
+
+
+def get_revision(meta):
+    """Return the Alembic revision of the database or None"""
+
+    try:
+        return meta.bind.execute(
+            text("SELECT version_num FROM alembic_version")
+        ).scalar()
+    except Exception as e:
+        log.debug("no alembic revision found: %s", str(e))
+        return None
+
+
+def get_cache_file(meta, revision):
+    url = meta.bind.url
+    return os.path.join(
+        CACHE_DIRECTORY, f"schema-{url.host}-{url.database}-{revision}.pickle"
+    )
+
+
+def load(meta, table_names, cache=False):
+    """Reflect the tables in table_names into meta, from the on-disk cache
+    with cache if the Alembic revision of the database did not change"""
+
+    revision = get_revision(meta) if cache else None
+    if revision:
+        cache_file = get_cache_file(meta, revision)
+        if os.path.exists(cache_file):
+            with open(cache_file, "rb") as fp:
+                cached = pickle.load(fp)
+            for table in cached.sorted_tables:
+                if table.name not in meta.tables:
+                    table.tometadata(meta)
+
+    missing = [name for name in table_names if name not in meta.tables]
+    if not missing:
+        return
+
+    log.debug("reflecting tables %s", ", ".join(missing))
+    meta.reflect(only=missing)
+
+    if revision:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        with open(cache_file, "wb") as fp:
+            pickle.dump(meta, fp)
+
+
+def table(meta, name):
+    """Return a table, reflected only if it was not loaded before"""
+
+    if name in meta.tables:
+        return meta.tables[name]
+    return Table(name, meta, autoload=True)
@@ -7,7 +7,9 @@ from dateutil import parser
 from loguru import logger
 import openstack
 from oslo_config import cfg
-from prompt_toolkit import prompt
+
+import batch
+import inventory
 
 PROJECT_NAME = "server"
 CONF = cfg.CONF
@@ -32,23 +34,46 @@ logger.remove()
 logger.add(sys.stderr, format=log_fmt, level=level, colorize=True)
 
 
+def get_server(cloud, server_id):
+    return cloud.compute.get_server(server_id)
+
+
 # Connect to the OpenStack environment
 cloud = openstack.connect(cloud=CONF.cloud)
+plan = batch.Plan()
 
 # build
-for server in cloud.compute.servers(all_projects=True, status="build"):
+for server in inventory.listing(
+    "compute.servers", cloud.compute.servers, all_projects=True, status="build"
+):
     duration = datetime.now(timezone.utc) - parser.parse(server.created_at)
     if duration.total_seconds() > 7200:
         logger.info(f"Server {server.id} hangs in BUILD status for more than 2 hours")
-        result = prompt(f"Delete server {server.id} [yes/no]: ")
-        if result == "yes":
-            logger.info(f"Deleting server {server.id}")
-            cloud.compute.delete_server(server.id, force=True)
+        plan.run(
+            cloud,
+            server.id,
+            "Deleting server",
+            lambda cloud, server_id=server.id: cloud.compute.delete_server(
+                server_id, force=True
+            ),
+            f"Delete server {server.id}",
+            check=batch.unchanged(server, get_server),
+        )
 
 # error
-for server in cloud.compute.servers(all_projects=True, status="error"):
+for server in inventory.listing(
+    "compute.servers", cloud.compute.servers, all_projects=True, status="error"
+):
     logger.info(f"Server {server.id} ({server.name}) is in ERROR status")
-    result = prompt(f"Delete server {server.id} [yes/no]: ")
-    if result == "yes":
-        logger.info(f"Deleting server {server.id}")
-        cloud.compute.delete_server(server.id, force=True)
+    plan.run(
+        cloud,
+        server.id,
+        "Deleting server",
+        lambda cloud, server_id=server.id: cloud.compute.delete_server(
+            server_id, force=True
+        ),
+        f"Delete server {server.id}",
+        check=batch.unchanged(server, get_server),
+    )
+
+plan.apply()
@@ -8,13 +8,26 @@ from dateutil import parser
 from loguru import logger
 import openstack
 from oslo_config import cfg
-from prompt_toolkit import prompt
+
+import batch
+import inventory
 
 PROJECT_NAME = "server"
 CONF = cfg.CONF
 opts = [
     cfg.BoolOpt("debug", help="Enable debug logging", default=False),
     cfg.StrOpt("cloud", help="Cloud name in clouds.yaml", default="service"),
+    cfg.BoolOpt(
+        "single-pass",
+        help="List all volumes once instead of once per handled status",
+        default=False,
+    ),
+    cfg.IntOpt(
+        "page-size",
+        help="Number of volumes requested per page in single pass mode",
+        default=1000,
+        min=1,
+    ),
 ]
 CONF.register_cli_opts(opts)
 CONF(sys.argv[1:], project=PROJECT_NAME)
@@ -35,53 +48,107 @@ logger.remove()
 logger.add(sys.stderr, format=log_fmt, level=level, colorize=True)
 
 
-# Connect to the OpenStack environment
-cloud = openstack.connect(cloud=CONF.cloud)
+def reset_and_delete_volume(cloud, volume_id):
+    cloud.block_storage.reset_volume_status(
+        volume_id, status="available", attach_status=None, migration_status=None
+    )
+    sleep(SLEEP_WAIT_FOR_API)
+    cloud.block_storage.delete_volume(volume_id, force=True)
+
+
+def get_volume(cloud, volume_id):
+    return cloud.block_storage.get_volume(volume_id)
+
 
-# detaching
-for volume in cloud.block_storage.volumes(all_projects=True, status="detaching"):
+def handle_detaching(volume):
     duration = datetime.now(timezone.utc) - parser.parse(volume.created_at)
     if duration.total_seconds() > 7200:
         logger.info(
             f"Volume {volume.id} hangs in DETACHING status for more than 2 hours"
         )
-        logger.info(f"Aborting detach of attachment(s) of volume {volume.id}")
-        cloud.block_storage.abort_volume_detaching(volume.id)
+        plan.run(
+            cloud,
+            volume.id,
+            "Aborting detach of attachment(s) of volume",
+            lambda cloud: cloud.block_storage.abort_volume_detaching(volume.id),
+            check=batch.unchanged(volume, get_volume),
+        )
+
 
-# creating
-for volume in cloud.block_storage.volumes(all_projects=True, status="creating"):
+def handle_creating(volume):
     duration = datetime.now(timezone.utc) - parser.parse(volume.created_at)
     if duration.total_seconds() > 7200:
         logger.info(
             f"Volume {volume.id} hangs in CREATING status for more than 2 hours"
         )
-        result = prompt(f"Delete volume {volume.id} [yes/no]: ")
-        if result == "yes":
-            logger.info(f"Deleting volume {volume.id}")
-            cloud.block_storage.delete_volume(volume.id, force=True)
+        plan.run(
+            cloud,
+            volume.id,
+            "Deleting volume",
+            lambda cloud: cloud.block_storage.delete_volume(volume.id, force=True),
+            f"Delete volume {volume.id}",
+            check=batch.unchanged(volume, get_volume),
+        )
 
-# error_deleting
-for volume in cloud.block_storage.volumes(all_projects=True, status="error_deleting"):
+
+def handle_error_deleting(volume):
     logger.info(f"Volume {volume.id} hangs in ERROR_DELETING status")
-    result = prompt(f"Retry to delete volume {volume.id} [yes/no]: ")
-    if result == "yes":
-        logger.info(f"Deleting volume {volume.id}")
-        cloud.block_storage.delete_volume(volume.id, force=True)
+    plan.run(
+        cloud,
+        volume.id,
+        "Deleting volume",
+        lambda cloud: cloud.block_storage.delete_volume(volume.id, force=True),
+        f"Retry to delete volume {volume.id}",
+        check=batch.unchanged(volume, get_volume),
+    )
+
 
-# deleting
-for volume in cloud.block_storage.volumes(all_projects=True, status="deleting"):
+def handle_deleting(volume):
     duration = datetime.now(timezone.utc) - parser.parse(volume.created_at)
     if duration.total_seconds() > 7200:
         logger.info(
             f"Volume {volume.id} hangs in DELETING status for more than 2 hours"
         )
-        result = prompt(f"Retry deletion of volume {volume.id} [yes/no]: ")
-        if result == "yes":
-            logger.info(f"Deleting volume {volume.id}")
-            cloud.block_storage.reset_volume_status(
-                volume.id, status="available", attach_status=None, migration_status=None
-            )
-            sleep(SLEEP_WAIT_FOR_API)
-            cloud.block_storage.delete_volume(volume.id, force=True)
+        plan.run(
+            cloud,
+            volume.id,
+            "Resetting and deleting volume",
+            lambda cloud: reset_and_delete_volume(cloud, volume.id),
+            f"Retry deletion of volume {volume.id}",
+            check=batch.unchanged(volume, get_volume),
+        )
+
+
+# Volume status -> handler, the volumes are handled in this order
+HANDLERS = {
+    "detaching": handle_detaching,
+    "creating": handle_creating,
+    "error_deleting": handle_error_deleting,
+    "deleting": handle_deleting,
+}
+
+
+# Connect to the OpenStack environment
+cloud = openstack.connect(cloud=CONF.cloud)
+plan = batch.Plan()
+
+if CONF.single_pass:
+    # All volumes are listed once and dispatched by their status, the volume
+    # API does not return the status without the detailed representation.
+    for volume in cloud.block_storage.volumes(all_projects=True, limit=CONF.page_size):
+        handler = HANDLERS.get(volume.status)
+        if handler:
+            handler(volume)
+else:
+    for status, handler in HANDLERS.items():
+        for volume in inventory.listing(
+            "block_storage.volumes",
+            cloud.block_storage.volumes,
+            all_projects=True,
+            status=status,
+        ):
+            handler(volume)
+
+plan.apply()
 
 # error
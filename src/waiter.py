@@ -0,0 +1,496 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# Shared waiters for the amphorae of many load balancers and for many servers.
+# Each tick lists the amphorae once per watched status or the changed servers
+# once, independent of the number of watches, and fires the callbacks of all
+# completed watches.
+
+from datetime import datetime, timedelta, timezone
+import time
+
+from loguru import logger
+import openstack
+
+# The interval between two ticks starts at SLEEP_MIN and is doubled up to
+# SLEEP_MAX while no watch completes.
+SLEEP_MIN = 1
+SLEEP_MAX = 5
+
+# A watched status that does not show up within this many seconds is treated
+# as already passed, e.g. when the amphora booted before the first tick.
+GRACE = 10
+
+# A load balancer still in PENDING_UPDATE this many seconds after its
+# amphorae left the watched status fails the watch.
+TIMEOUT_PENDING_UPDATE = 600
+
+# A failover rejected with a conflict, e.g. because the loadbalancer is still
+# in a PENDING_* status, is retried after this many seconds, doubled on every
+# further attempt.
+SLEEP_RETRY_CONFLICT = 10
+
+# The server waiter lists all servers changed since it was created, minus this
+# many seconds to cover clock skew between this host and the API.
+CHANGES_SINCE_MARGIN = 300
+
+# Final states of a failed migration
+MIGRATION_FAILED = ["error", "failed", "cancelled"]
+
+
+class Watch:
+    def __init__(self, loadbalancer_id, status, timeout, callback):
+        self.loadbalancer_id = loadbalancer_id
+        self.status = status
+        self.callback = callback
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.seen = False
+        self.pending_since = None
+
+
+class AmphoraWaiter:
+    """Waits until the amphorae of load balancers left a status"""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.watches = []
+        self.interval = SLEEP_MIN
+
+    def __len__(self) -> int:
+        return len(self.watches)
+
+    def watch(self, loadbalancer_id, status, timeout, callback=None):
+        """Call callback(loadbalancer_id, completed) once no amphora of the
+        load balancer is in the status anymore and the load balancer left
+        PENDING_UPDATE, completed is False when the timeout is reached or the
+        load balancer went to ERROR"""
+
+        logger.info(
+            f"Wait up to {timeout} seconds for amphorae of loadbalancer {loadbalancer_id} to leave {status}"
+        )
+        self.watches.append(Watch(loadbalancer_id, status, timeout, callback))
+        self.interval = SLEEP_MIN
+
+    def tick(self):
+        busy = set()
+        for status in {watch.status for watch in self.watches}:
+            for amphora in self.cloud.load_balancer.amphorae(status=status):
+                busy.add((amphora.loadbalancer_id, status))
+
+        # a failed failover leaves the loadbalancer in provisioning_status ERROR
+        failed = {
+            load_balancer.id
+            for load_balancer in self.cloud.load_balancer.load_balancers(
+                provisioning_status="ERROR"
+            )
+        }
+
+        # the failover is still running, e.g. the old amphorae are not yet in
+        # PENDING_DELETE
+        pending = {
+            load_balancer.id
+            for load_balancer in self.cloud.load_balancer.load_balancers(
+                provisioning_status="PENDING_UPDATE"
+            )
+        }
+
+        now = time.monotonic()
+        completed = []
+        for watch in self.watches:
+            if watch.loadbalancer_id in failed:
+                logger.warning(
+                    f"Loadbalancer {watch.loadbalancer_id} is in provisioning_status ERROR"
+                )
+                completed.append((watch, False))
+            elif (watch.loadbalancer_id, watch.status) in busy:
+                watch.seen = True
+                if now > watch.deadline:
+                    logger.warning(
+                        f"Amphorae of loadbalancer {watch.loadbalancer_id} are still in {watch.status}"
+                    )
+                    completed.append((watch, False))
+            elif watch.loadbalancer_id in pending:
+                if watch.pending_since is None:
+                    watch.pending_since = now
+                elif now - watch.pending_since > TIMEOUT_PENDING_UPDATE:
+                    logger.warning(
+                        f"Loadbalancer {watch.loadbalancer_id} is still in provisioning_status PENDING_UPDATE"
+                    )
+                    completed.append((watch, False))
+            elif watch.seen or now - watch.started > GRACE:
+                completed.append((watch, True))
+
+        # callbacks may add new watches, e.g. the delete after the boot
+        for watch, _ in completed:
+            self.watches.remove(watch)
+        for watch, result in completed:
+            if watch.callback:
+                watch.callback(watch.loadbalancer_id, result)
+
+        if completed:
+            self.interval = SLEEP_MIN
+        else:
+            self.interval = min(self.interval * 2, SLEEP_MAX)
+
+    def wait(self):
+        """Tick until all watches are completed"""
+
+        while self.watches:
+            self.tick()
+            if self.watches:
+                time.sleep(self.interval)
+
+
+class Failover:
+    def __init__(self, name, loadbalancer_id, trigger, labels):
+        self.name = name
+        self.loadbalancer_id = loadbalancer_id
+        self.trigger = trigger
+        self.labels = labels
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class FailoverScheduler:
+    """Runs up to parallel failovers at once, with optional limits per label
+
+    A failover is queued with its labels, e.g. {"availability_zone": {"az1"}}.
+    It is admitted as soon as fewer than parallel failovers are in flight, no
+    other failover of its loadbalancer is in flight and no limit of one of its
+    label values is reached. A failover rejected with a conflict is retried
+    up to retries times, a failover rejected with any other error fails."""
+
+    def __init__(self, waiter, watch, parallel, limits=None, retries=0):
+        self.waiter = waiter
+        self.watch = watch
+        self.parallel = parallel
+        self.limits = {key: limit for key, limit in (limits or {}).items() if limit}
+        self.retries = retries
+        self.queue = []
+        self.running = {}
+        self.results = {}
+
+    def add(self, loadbalancer_id, trigger, labels=None, name=None):
+        name = name or f"loadbalancer {loadbalancer_id}"
+        self.queue.append(Failover(name, loadbalancer_id, trigger, labels or {}))
+
+    def admissible(self, failover):
+        if len(self.running) >= self.parallel:
+            return False
+        if failover.loadbalancer_id in self.running:
+            return False
+        if failover.not_before > time.monotonic():
+            return False
+
+        for key, limit in self.limits.items():
+            for value in failover.labels.get(key, []):
+                running = [
+                    1
+                    for running in self.running.values()
+                    if value in running.labels.get(key, [])
+                ]
+                if len(running) >= limit:
+                    return False
+
+        return True
+
+    def finish(self, loadbalancer_id, completed):
+        failover = self.running.pop(loadbalancer_id)
+        self.results[failover.name] = "DONE" if completed else "FAILED"
+        logger.info(
+            f"Failover of {failover.name} finished ({self.results[failover.name]}), "
+            f"{len(self.results)} finished, {len(self.running)} in flight, {len(self.queue)} queued"
+        )
+
+    def admit(self):
+        for failover in list(self.queue):
+            if not self.admissible(failover):
+                continue
+
+            self.queue.remove(failover)
+            failover.attempts = failover.attempts + 1
+            try:
+                failover.trigger()
+            except openstack.exceptions.ConflictException as e:
+                if failover.attempts <= self.retries:
+                    delay = SLEEP_RETRY_CONFLICT * 2 ** (failover.attempts - 1)
+                    logger.warning(
+                        f"Failover of {failover.name} failed ({e}), retrying in {delay} seconds"
+                    )
+                    failover.not_before = time.monotonic() + delay
+                    self.queue.append(failover)
+                else:
+                    logger.warning(f"Failover of {failover.name} failed: {e}")
+                    self.results[failover.name] = "CONFLICT"
+                continue
+            except openstack.exceptions.SDKException as e:
+                logger.warning(f"Failover of {failover.name} failed: {e}")
+                self.results[failover.name] = f"FAILED ({e})"
+                continue
+
+            self.running[failover.loadbalancer_id] = failover
+            self.watch(failover.loadbalancer_id, self.finish)
+
+    def run(self):
+        """Admit the queued failovers until all of them are finished"""
+
+        while self.queue or self.running:
+            self.admit()
+            logger.debug(
+                f"{len(self.running)} failovers in flight, {len(self.queue)} queued"
+            )
+            if self.running:
+                self.waiter.tick()
+            if self.queue or self.running:
+                time.sleep(self.waiter.interval)
+
+        if self.results:
+            summary = {}
+            for result in self.results.values():
+                summary[result] = summary.get(result, 0) + 1
+            logger.info(
+                "Failovers finished: "
+                + ", ".join(f"{count} {result}" for result, count in summary.items())
+            )
+
+        return self.results
+
+
+class ServerWatch:
+    def __init__(self, server_id, status, timeout, callback, source):
+        self.server_id = server_id
+        self.status = status
+        self.callback = callback
+        self.source = source
+        self.deadline = time.monotonic() + timeout
+
+
+class ServerWaiter:
+    """Waits until servers reached a status"""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        self.watches = []
+        self.interval = SLEEP_MIN
+        self.since = datetime.now(timezone.utc) - timedelta(
+            seconds=CHANGES_SINCE_MARGIN
+        )
+
+    def __len__(self) -> int:
+        return len(self.watches)
+
+    def watch(self, server_id, status, timeout, callback=None, source=None):
+        """Call callback(server_id, completed) once the server is in the
+        status, and with source no longer on the compute host source, or the
+        server went to ERROR or the timeout is reached"""
+
+        logger.debug(
+            f"Wait up to {timeout} seconds for server {server_id} to reach {status}"
+        )
+        self.watches.append(ServerWatch(server_id, status, timeout, callback, source))
+        self.interval = SLEEP_MIN
+
+    def check(self, now):
+        """Return the completed watches with their results"""
+
+        # every server that was acted on since the waiter was created shows up
+        # in one listing, independent of its compute host
+        servers = {
+            server.id: server
+            for server in self.cloud.compute.servers(
+                all_projects=True, changes_since=self.since.isoformat()
+            )
+        }
+
+        completed = []
+        for watch in self.watches:
+            server = servers.get(watch.server_id)
+            if server and server.status == "ERROR":
+                logger.warning(f"Server {watch.server_id} is in status ERROR")
+                completed.append((watch, False))
+            elif (
+                server
+                and server.status == watch.status
+                and (not watch.source or server.compute_host != watch.source)
+            ):
+                completed.append((watch, True))
+            elif now > watch.deadline:
+                logger.warning(f"Server {watch.server_id} did not reach {watch.status}")
+                completed.append((watch, False))
+
+        return completed
+
+    def tick(self):
+        completed = self.check(time.monotonic())
+
+        # callbacks may add new watches, e.g. the start after the evacuation
+        for watch, _ in completed:
+            self.watches.remove(watch)
+        for watch, result in completed:
+            if watch.callback:
+                watch.callback(watch.server_id, result)
+
+        if completed:
+            self.interval = SLEEP_MIN
+        else:
+            self.interval = min(self.interval * 2, SLEEP_MAX)
+
+    def wait(self):
+        """Tick until all watches are completed"""
+
+        while self.watches:
+            self.tick()
+            if self.watches:
+                time.sleep(self.interval)
+
+
+class MigrationWaiter(ServerWaiter):
+    """Waits until the live migrations of servers reached a status
+
+    The migrations that already existed when the waiter was created are
+    ignored, the newest other migration of a server is the one watched."""
+
+    def __init__(self, cloud):
+        super().__init__(cloud)
+        self.known = {migration.id for migration in self.migrations()}
+
+    def migrations(self):
+        return self.cloud.compute.migrations(
+            migration_type="live-migration", changes_since=self.since.isoformat()
+        )
+
+    def check(self, now):
+        migrations = {}
+        for migration in self.migrations():
+            if migration.id in self.known:
+                continue
+            latest = migrations.get(migration.server_id)
+            if not latest or migration.id > latest.id:
+                migrations[migration.server_id] = migration
+
+        completed = []
+        for watch in self.watches:
+            migration = migrations.get(watch.server_id)
+            if migration and migration.status == watch.status:
+                completed.append((watch, True))
+            elif migration and migration.status in MIGRATION_FAILED:
+                logger.warning(
+                    f"Live migration of server {watch.server_id} is in status {migration.status}"
+                )
+                completed.append((watch, False))
+            elif now > watch.deadline:
+                logger.warning(
+                    f"Live migration of server {watch.server_id} did not reach {watch.status}"
+                )
+                completed.append((watch, False))
+            elif migration and migration.status == "running":
+                self.progress(watch.server_id)
+
+        return completed
+
+    def progress(self, server_id):
+        for migration in self.cloud.compute.server_migrations(server_id):
+            if migration.memory_total_bytes:
+                percent = (
+                    100
+                    * migration.memory_processed_bytes
+                    // migration.memory_total_bytes
+                )
+                logger.info(
+                    f"Live migration of server {server_id} to {migration.dest_compute}: "
+                    f"{percent}% of the memory processed, "
+                    f"{migration.memory_remaining_bytes} bytes remaining"
+                )
+
+
+class Step:
+    """One action on a server, e.g. a stop, followed by a wait for status
+
+    Without status the step is completed as soon as the action returned."""
+
+    def __init__(self, description, trigger, status=None, timeout=0, source=None):
+        self.description = description
+        self.trigger = trigger
+        self.status = status
+        self.timeout = timeout
+        self.source = source
+
+
+class ServerScheduler:
+    """Runs the steps of up to parallel servers at once, the steps of one
+    server run in order and a failed step skips the remaining steps"""
+
+    def __init__(self, waiter, parallel):
+        self.waiter = waiter
+        self.parallel = parallel
+        self.queue = []
+        self.running = {}
+        self.results = {}
+
+    def add(self, server_id, steps):
+        self.queue.append((server_id, list(steps)))
+
+    def advance(self, server_id, completed=True):
+        steps = self.running[server_id]
+
+        if not completed:
+            self.results[server_id] = f"FAILED ({steps[0].description})"
+            del self.running[server_id]
+            return
+
+        steps.pop(0)
+        if not steps:
+            self.results[server_id] = "DONE"
+            del self.running[server_id]
+            logger.info(
+                f"Server {server_id} finished, {len(self.results)} finished, "
+                f"{len(self.running)} in flight, {len(self.queue)} queued"
+            )
+            return
+
+        self.start(server_id)
+
+    def start(self, server_id):
+        step = self.running[server_id][0]
+
+        logger.info(f"{step.description} {server_id}")
+        try:
+            step.trigger()
+        except openstack.exceptions.SDKException as e:
+            logger.warning(f"{step.description} {server_id} failed: {e}")
+            self.results[server_id] = f"FAILED ({step.description}: {e})"
+            del self.running[server_id]
+            return
+
+        if step.status:
+            self.waiter.watch(
+                server_id, step.status, step.timeout, self.advance, step.source
+            )
+        else:
+            self.advance(server_id)
+
+    def run(self):
+        """Start the queued servers until all of them are finished"""
+
+        while self.queue or self.running:
+            while self.queue and len(self.running) < self.parallel:
+                server_id, steps = self.queue.pop(0)
+                self.running[server_id] = steps
+                self.start(server_id)
+
+            if self.running:
+                self.waiter.tick()
+                if self.running:
+                    time.sleep(self.waiter.interval)
+
+        if self.results:
+            summary = {}
+            for result in self.results.values():
+                result = result.split(" ")[0]
+                summary[result] = summary.get(result, 0) + 1
+            logger.info(
+                "Servers finished: "
+                + ", ".join(f"{count} {result}" for result, count in summary.items())
+            )
+
+        return self.results